@@ -21,36 +21,27 @@
 #   Added automatic pitch detection if the JS ReaScript API installed.
 
 
+import time
+startup_time = time.perf_counter()
+
 import reapy as rp
 import tkinter as tk
 import tkinter.ttk as ttk
 import tkinter.font as tkfont
 
-try:
-    import tkinterdnd2
-    dnd_available = True
-    print("Drag-and-drop available")
-except:
-    print("Install tkinterdnd2 for drag-and-drop support.")
-    dnd_available = False
-
-try:
-    from tktooltip import ToolTip
-    tooltip_available = True
-    print("Tooltips available")
-except:
-    print("Install tkinter-tooltip for drag-and-drop support.")
-    tooltip_available = False
-
-import webbrowser
-import subprocess
-import traceback
-import random
+# The optional packages tkinterdnd2 and numpy are only imported once the
+# window is shown, see `startup_deferred`.
+dnd_available = False
+numpy_available = False
+np = None
+
+import base64
+import struct
 import socket
-import pickle
+import threading
 import queue
-import time
 import math
+import heapq
 import sys
 import os
 import re
@@ -88,10 +79,26 @@ resize_handle_ratio_small = 1/3 # When the range size is smaller than trice
 
 scroll_speed = 1                 # Speed to scroll.
 zoom_speed = 1                   # Speed to zoom.
+zoom_settle_delay = 150          # Time in ms after zooming before the names of the note
+                                 # ranges are laid out again.
 default_window_size = '1000x400' # Default window size in pixels.
 max_recursion_depth = 10         # Max. depth to look for ReaSamplOmatics in send tracks
                                  # of the selected track.
 tooltip_delay = 1.0              # Amount of seconds it takes for tooltips to show up.
+sync_interval_min = 100          # Interval in ms to check REAPER for changes. While
+sync_interval_max = 1000         # nothing changes, the interval slowly grows up to
+sync_backoff = 1.5               # the maximum, multiplying with the backoff factor
+                                 # every time. It snaps back after any change.
+write_back_delay = 50            # Time in ms to collect changes to the note ranges before
+                                 # writing them all to REAPER at once.
+results_interval = 250           # Interval in ms to pick up the results of REAPER commands,
+                                 # in case the REAPER thread could not wake up the window.
+print_startup_timings = False    # Print how long each phase of starting up takes.
+resident = 1                     # Keep running when the window is closed, such that it
+                                 # opens instantly the next time it is launched. Use `Quit`
+                                 # in the right click menu to stop. Set to 0 to allow
+                                 # multiple windows at once.
+control_port = 47362             # Local port on which the resident instance listens.
 
 # Configuration options - Appearance
 highlight = 1            # Thickness of the highlights. Set to 0 for a "flat" look.
@@ -185,13 +192,15 @@ current_track = None
 current_track_routing = None
 samploranges = []
 last_touched = None
+range_font = None
 root = None
 root = None
 scrollbar = None
 canvas = None
 window = None
-pianoroll_frame = None
-pixel = None
+pianoroll_keys = []
+pianoroll_labels = {}
+pianoroll_y = 0
 track_name_text = None
 track_name_label = None
 render_groups = []
@@ -204,75 +213,261 @@ detect_pitch_script_id = 0
 # Constants
 total_notes = 128
 
+# Parameter indices of ReaSamplOmatic5000.
+param_gain_min_velocity = 2
+param_note_start = 3
+param_note_end = 4
+param_pitch_start = 5
+param_obey_note_offs = 11
+
+# The I_MIDIFLAGS of a send which does not send MIDI.
+midi_flags_no_midi = 0b1111111100000000011111
+
+# The height of the area of the canvas above the pianoroll.
+def range_height():
+    return int(window.winfo_height() - piano_roll_height)
+
+# Returns the position and size (x, y, width, height) of a sample range
+# with the given notes and layer, when the ranges are `max_height` high.
+def range_geometry(start, end, layer, layer_count, max_height):
+    width = int(width_per_note * (end - start + 1))
+    height = max_height // layer_count
+
+    x_pos = int(width_per_note * start)
+    y_pos = layer * height
+
+    # The last layer should be a bit larger, when
+    # `layer_count` does not divide `max_height`.
+    if layer == layer_count - 1:
+        height += max_height - layer_count * height
+
+    return x_pos, y_pos, width, height
+
 def rgb(rgb, a = 1):
     return "#%02x%02x%02x" % (int(rgb[0]*a), int(rgb[1]*a), int(rgb[2]*a))
 
 def rgb2tuple(t):
     return (eval(f"0x{t[1:3]}"), eval(f"0x{t[3:5]}"), eval(f"0x{t[5:7]}"))
 
-# The main note range class.
+
+# # # Range store # # #
+
+# The note range, layer and state of all sample ranges, stored column-wise.
+# Every `SamploRange` is a view on one row, such that operations on many
+# ranges at once (moving, resizing, stretching and hit testing) are done on
+# whole columns. The columns are lists until numpy is loaded (if installed),
+# see `load_numpy`.
+class RangeStore():
+    fields = ("start", "end", "layer", "layer_count", "resize_start",
+              "resize_end", "mute", "solo")
+
+    def __init__(self):
+        self.size = 0
+        self.capacity = 0
+        self.free = []
+        self.columns = {field: self.new_column(0) for field in self.fields}
+
+    def new_column(self, size):
+        if numpy_available:
+            return np.zeros(size, dtype=np.int64)
+        return [0] * size
+
+    # Returns a cleared row, growing the columns if necessary.
+    def add(self):
+        if self.free:
+            row = self.free.pop()
+        else:
+            row = self.size
+            self.size += 1
+
+        if self.size > self.capacity:
+            self.capacity = max(64, 2 * self.capacity)
+            for field, column in self.columns.items():
+                grown = self.new_column(self.capacity)
+                grown[:len(column)] = column
+                self.columns[field] = grown
+
+        for column in self.columns.values():
+            column[row] = 0
+        return row
+
+    def remove(self, row):
+        self.free.append(row)
+
+    def use_numpy(self):
+        for field, column in self.columns.items():
+            self.columns[field] = np.array(column, dtype=np.int64)
+
+    # Remember the note ranges at the start of resizing.
+    def begin_resize(self, rows):
+        c = self.columns
+        if numpy_available:
+            c["resize_start"][rows] = c["start"][rows]
+            c["resize_end"][rows] = c["end"][rows]
+        else:
+            for row in rows:
+                c["resize_start"][row] = c["start"][row]
+                c["resize_end"][row] = c["end"][row]
+
+    # Move the note ranges by `amount` notes.
+    def move(self, rows, amount):
+        start, end = self.columns["start"], self.columns["end"]
+        if numpy_available:
+            start[rows] += amount
+            end[rows] += amount
+        else:
+            for row in rows:
+                start[row] += amount
+                end[row] += amount
+
+    # Resize the note ranges by `amount` notes, relative to the note ranges
+    # at the start of resizing. Resizes the end if `side` > 0, else the start.
+    def resize(self, rows, side, amount):
+        c = self.columns
+        if numpy_available:
+            if side > 0:
+                c["end"][rows] = np.maximum(c["start"][rows], c["resize_end"][rows] + amount)
+            else:
+                c["start"][rows] = np.minimum(c["end"][rows], c["resize_start"][rows] + amount)
+        else:
+            for row in rows:
+                if side > 0:
+                    c["end"][row] = max(c["start"][row], c["resize_end"][row] + amount)
+                else:
+                    c["start"][row] = min(c["end"][row], c["resize_start"][row] + amount)
+
+    # Scale the note ranges at the start of resizing by `scale`, around
+    # `base_note`. Returns the indices (in `rows`) of the changed ranges.
+    def stretch(self, rows, base_note, scale):
+        c = self.columns
+        if numpy_available:
+            first = (c["resize_start"][rows] - base_note) * scale + base_note
+            last = (c["resize_end"][rows] + 1 - base_note) * scale + base_note
+            start = np.trunc(first).astype(np.int64)
+            end = np.maximum(start, np.trunc(last - 1).astype(np.int64))
+
+            changed = (c["start"][rows] != start) | (c["end"][rows] != end)
+            c["start"][rows] = start
+            c["end"][rows] = end
+            return np.flatnonzero(changed).tolist()
+
+        changed = []
+        for i, row in enumerate(rows):
+            start = int((c["resize_start"][row] - base_note) * scale + base_note)
+            end = max(start, int((c["resize_end"][row] + 1 - base_note) * scale
+                                 + base_note - 1))
+            if c["start"][row] != start or c["end"][row] != end:
+                c["start"][row] = start
+                c["end"][row] = end
+                changed.append(i)
+        return changed
+
+    # Returns the indices (in `rows`) of the ranges which intersect the
+    # rectangle `box` (x0, y0, x1, y1). See `range_geometry`.
+    def intersect(self, rows, box, max_height):
+        c = self.columns
+        if not numpy_available:
+            inside = []
+            for i, row in enumerate(rows):
+                x, y, w, h = range_geometry(c["start"][row], c["end"][row], c["layer"][row],
+                                            c["layer_count"][row], max_height)
+                if rectangle_intersect(box, [x, y, x + w, y + h]):
+                    inside.append(i)
+            return inside
+
+        start, end = c["start"][rows], c["end"][rows]
+        layer, layer_count = c["layer"][rows], c["layer_count"][rows]
+        width = (width_per_note * (end - start + 1)).astype(np.int64)
+        height = max_height // layer_count
+        x_pos = (width_per_note * start).astype(np.int64)
+        y_pos = layer * height
+        height = np.where(layer == layer_count - 1,
+                          height + max_height - layer_count * height, height)
+
+        outside = ((box[2] < x_pos) | (x_pos + width < box[0]) |
+                   (box[3] < y_pos) | (y_pos + height < box[1]))
+        return np.flatnonzero(~outside).tolist()
+
+range_store = RangeStore()
+
+def store_field(field, kind=int):
+    return property(lambda self: kind(range_store.columns[field][self.row]),
+                    lambda self, value: range_store.columns[field].__setitem__(self.row, value))
+
+# Redraw the sample ranges after their note ranges changed in the store,
+# and move them through the render groups. Only the note arithmetic is done
+# on whole columns; the groups are still updated one range at a time.
+def ranges_changed(sranges):
+    for srange in sranges:
+        mark_dirty(srange, color=False)
+        srange.check_change()
+
+def move_ranges(sranges, amount):
+    range_store.move([s.row for s in sranges], amount)
+    ranges_changed(sranges)
+
+# See `RangeStore.resize`.
+def resize_ranges(sranges, side, amount):
+    range_store.resize([s.row for s in sranges], side, amount)
+    ranges_changed(sranges)
+
+# The main note range class. The note range and state of the FX are passed
+# in, since all reading from REAPER is done by the REAPER worker.
+# `fx_name` is the name of the FX in REAPER, `name` the name to display.
 class SamploRange():
-    def __init__(self, window, fx, color=(255, 255, 255), note_start=-1, note_end=-1, name=None):
+    # The note range and state, see `RangeStore`.
+    start = store_field("start")
+    end = store_field("end")
+    layer = store_field("layer")
+    layer_count = store_field("layer_count")
+    resize_start = store_field("resize_start")
+    resize_end = store_field("resize_end")
+    mute = store_field("mute", bool)
+    solo = store_field("solo", bool)
+
+    def __init__(self, window, fx, color=(255, 255, 255), note_start=-1, note_end=-1,
+                 name=None, mute=False, fx_name=None):
+        self.row = range_store.add()
         self.window = window
         self.max_height = -1
         self.fx = fx
 
-        if fx:
-            with rp.inside_reaper():
-                self.index = fx.index
-                self.start = round(fx.params["Note range start"] * 127)
-                self.end = round(fx.params["Note range end"] * 127)
-                self.mute = not fx.is_enabled
-        else:
-            self.index = -1
-            self.start = note_start
-            self.end = note_end
-            self.mute = False
+        self.start = note_start
+        self.end = note_end
+        self.mute = mute
+        self.fx_name = fx_name
         self.solo = False
 
         # Filename (only used for drag-and-drop functionality)
         self.filename = None
 
-        # Create the moveable widget.
+        # Create the rectangle on the canvas. Its mouse events are handled
+        # by `range_press` and friends.
         global alpha
-        font = tkfont.Font(size=8)
         self.color = color if color != (0, 0, 0) else rgb2tuple(default_color)
-        self.widget = tk.Canvas(self.window,
-                                highlightthickness=highlight,
-                                highlightbackground=rgb(self.color),
-                                bg=rgb(self.color, alpha),
-                                bd=0)
-        self.widget.bind("<B1-Motion>", self.mouse)
-        self.widget.bind("<ButtonRelease-1>", self.button_release)
-        self.widget.bind("<Motion>", self.motion)
-        self.widget.bind('<Double-Button-1>', lambda e: self.show(True))
-        self.widget.bind('<Alt-1>' if not on_macOS else '<Option-1>', lambda e: self.set_alt())
-        self.widget.bind('<Button-1>', lambda e: self.select())
-        self.widget.bind('<Control-1>', lambda e: self.select(True))
-
-        self.tooltip = None
-        if tooltip_available:
-            self.tooltip = ToolTip(self.widget, delay=tooltip_delay,
-                    msg=f"Drag to move.\n"
-                         "Drag edges to resize.\n"
-                         "Alt+drag to stretch.\n\n"
-                         "Click to open UI\n"
-                         "Ctrl+click to add to\nselection.")
-
-        # Selection.
-        self.selected = False
+        self.rect = self.window.create_rectangle(0, 0, 0, 0, width=highlight,
+                                                 outline=rgb(self.color) if highlight else '',
+                                                 fill=rgb(self.color, alpha),
+                                                 tags="srange")
+
+        # Selection, see `selection`.
         self.select_multiple = False
 
         # Text.
         self.text_hor = None
         self.text_ver = None
+        self.text_ver_name = None
+        self.text_layout = None
         self.current_name = name
         self.changed_name = False
 
         # Render group information.
         self.render_group = None
+        self.group_range = None
         self.layer_count = 1
         self.layer = 0
+        self.geometry = None
+        self.layout_version = -1
 
         # Track routing
         self.track_routing = None
@@ -290,34 +485,50 @@ class SamploRange():
         self.resize_end = 0
         self.alt = False
 
-        self.prev_amount = -1000
         self.keep_ui_state = 0
 
     # # Drawing # #
-    def redraw(self):
-        # Position and sizes.
-        width = int(width_per_note * (self.end - self.start + 1))
-        self.max_height = int(window.winfo_height() - piano_roll_height)
-        height = self.max_height // self.layer_count
-
-        x_pos = int(width_per_note * self.start)
-        y_pos = self.layer * height
-
-        # The last layer should be a bit larger, when
-        # `layer_count` does not divide `max_height`.
-        if self.layer == self.layer_count - 1:
-            height += self.max_height - self.layer_count * height
-
-        # Adjust for the highlight offsets.
-        width -= adjust_for_highlight * highlight
-        height -= adjust_for_highlight * highlight
+    # Returns the position and size (x, y, width, height) of the rectangle,
+    # including the highlight. Pass `max_height` (see `range_height`) when
+    # doing many ranges at once, to ask Tk for it only once.
+    def get_geometry(self, max_height=None):
+        self.max_height = range_height() if max_height == None else max_height
+        return range_geometry(self.start, self.end, self.layer,
+                              self.layer_count, self.max_height)
+
+    def contains(self, x, y):
+        x_pos, y_pos, width, height = self.geometry
+        return x_pos <= x < x_pos + width and y_pos <= y < y_pos + height
+
+    # Move the rectangle and the text to the current position and size.
+    # This also shows the range again if it was hidden by `redraw_visible`.
+    def place(self, max_height=None):
+        if self.layout_version != layout_version:
+            self.layout_version = layout_version
+            self.text_layout = None
+            self.window.itemconfig(self.rect, state="normal")
+
+        x_pos, y_pos, width, height = self.geometry = self.get_geometry(max_height)
+
+        # The highlight is drawn on the edge of the rectangle.
+        inset = highlight / 2
+        self.window.coords(self.rect, x_pos + inset, y_pos + inset,
+                           x_pos + width - inset, y_pos + height - inset)
+        self.draw_name()
 
-        # Drawing.
-        self.widget.place(x=x_pos, y=y_pos)
-        self.widget.configure(width=width, height=height)
+    # Draw the range once Tk is idle, together with all other changes.
+    # See `mark_dirty`.
+    def redraw(self):
+        mark_dirty(self)
 
-        self.draw_name()
-        self.draw_color()
+    def destroy(self):
+        selection.discard(self)
+        dirty_ranges.pop(self, None)
+        range_store.remove(self.row)
+        self.window.delete(self.rect)
+        if self.text_hor:
+            self.window.delete(self.text_hor)
+            self.window.delete(self.text_ver)
 
     def draw_color(self):
         # Main color.
@@ -346,10 +557,10 @@ class SamploRange():
         else:
             text_hex = text_color
 
-        self.widget.configure(highlightbackground=hightlight_hex,
-                              bg=color_hex)
-        self.widget.itemconfig(self.text_hor, fill=text_hex)
-        self.widget.itemconfig(self.text_ver, fill=text_hex)
+        self.window.itemconfig(self.rect, fill=color_hex,
+                               outline=hightlight_hex if highlight else '')
+        self.window.itemconfig(self.text_hor, fill=text_hex)
+        self.window.itemconfig(self.text_ver, fill=text_hex)
 
     def get_name(self):
         global name_by_general_midi
@@ -364,8 +575,8 @@ class SamploRange():
                 name += f" {self.layer+1}"
         elif self.current_name:
             name = self.current_name
-        elif self.fx:
-            name = self.fx.name
+        elif self.fx_name:
+            name = self.fx_name
         else:
             name = default_fx_name
 
@@ -373,7 +584,6 @@ class SamploRange():
         if name.startswith(solo_prefix):
             name = name[len(solo_prefix):]
         if name.startswith(mute_prefix):
-            self.widget.itemconfig(self.text_hor, text=name)
             name = name[len(mute_prefix):]
         if self.solo:
             name = solo_prefix + name
@@ -383,46 +593,49 @@ class SamploRange():
         return name
 
 
+    # Draw the name, horizontally if it fits and otherwise vertically.
+    # The canvas is shared with the other ranges, so text which does not
+    # fit is cut off.
     def draw_name(self):
-        offscreen = -50
         name = self.get_name()
 
         # Initialise the text.
         if not self.text_hor:
             global text_color
-            self.text_hor = self.widget.create_text(1, 0, text=name,
-                    anchor="nw", fill=text_color)
-            self.text_ver = self.widget.create_text(offscreen, 0, text=name,
-                    anchor="nw", angle=90, fill=text_color)
+            self.text_hor = self.window.create_text(0, 0, text=name, font=range_font,
+                    anchor="nw", fill=text_color, tags="srange")
+            self.text_ver = self.window.create_text(0, 0, text=name, font=range_font,
+                    anchor="nw", angle=90, fill=text_color, state="hidden", tags="srange")
             self.current_name = name
 
         # Update name if necessary.
         if self.current_name != name:
-            self.widget.itemconfig(self.text_hor, text=name)
-            self.widget.itemconfig(self.text_ver, text=name)
+            self.window.itemconfig(self.text_hor, text=name)
             self.current_name = name
             self.changed_name = True
 
-        # Compute the bounding box.
-        box = self.widget.bbox(self.text_hor)
-        text_length = box[2] - box[0]
-        text_height = box[1] - box[3]
-        width = int(width_per_note * (self.end - self.start + 1))
+        # Nothing to do if the text would end up at the same place.
+        x_pos, y_pos, width, height = self.geometry
+        name_ver = name_layout(name, width, height)
+        text_layout = (name, name_ver, x_pos, y_pos)
+        if self.text_layout == text_layout:
+            return
+        self.text_layout = text_layout
 
-        if text_length + 5 > width:
+        if name_ver != None:
             # Place text vertically.
-            self.widget.moveto(self.text_hor, 0, offscreen)
+            self.window.itemconfig(self.text_hor, state="hidden")
 
-            # Make sure it aligns to the bottom if the text does not fit.
-            pos_adjust = min(0, self.widget.winfo_reqheight() - text_length)
-            if not pos_adjust:
-                self.widget.moveto(self.text_ver, 0, 2)
-            else:
-                self.widget.moveto(self.text_ver, 0, pos_adjust - 2)
+            if self.text_ver_name != name_ver:
+                self.window.itemconfig(self.text_ver, text=name_ver)
+                self.text_ver_name = name_ver
+            self.window.itemconfig(self.text_ver, state="normal" if name_ver else "hidden")
+            self.window.moveto(self.text_ver, x_pos, y_pos + 2)
         else:
             # Place text horizontally.
-            self.widget.moveto(self.text_hor, 3, 0)
-            self.widget.moveto(self.text_ver, offscreen, 0)
+            self.window.itemconfig(self.text_ver, state="hidden")
+            self.window.itemconfig(self.text_hor, state="normal")
+            self.window.moveto(self.text_hor, x_pos + 3, y_pos)
 
     # # Event Handlers # #
 
@@ -436,16 +649,18 @@ class SamploRange():
         if not self.fx:
             return
 
-        with rp.inside_reaper():
-            if exclusive:
-                for samplorange in samploranges:
-                    if not samplorange.fx.parent == self.fx.parent:
-                        samplorange.fx.close_ui()
-            else:
-                self.fx.open_ui()
+        if exclusive:
+            reaper_call(close_ui_in_reaper, [s.fx for s in samploranges if s.fx and
+                                              s.fx.parent_id != self.fx.parent_id])
+        else:
+            reaper_call(open_ui_in_reaper, self.fx)
+
+    @property
+    def selected(self):
+        return self in selection
 
     def select(self, keep_selection=False, retrigger=True):
-        if not self.select_multiple and not keep_selection:
+        if not (self.selected and self.select_multiple) and not keep_selection:
             deselect_all()
         if keep_selection:
             global last_touched
@@ -454,19 +669,16 @@ class SamploRange():
             self.select_multiple = True
 
         if retrigger and keep_selection and self.selected:
-            self.selected = False
+            selection.discard(self)
         else:
-            self.selected = True
-
-        self.redraw()
+            selection.add(self)
 
         # Necessary on some systems to close the popup menu.
         popup_close()
 
     def deselect(self):
-        self.selected = False
         self.select_multiple = False
-        self.draw_color()
+        selection.discard(self)
 
     # Mouse motion, saves x and y position of the cursor.
     def motion(self, event):
@@ -483,8 +695,7 @@ class SamploRange():
 
         self.in_motion = False
         self.resize_side = 0
-        root.after(10, self.update_reaper)
-        prev_amount = -1000
+        self.update_reaper()
         self.alt = False
 
 
@@ -492,9 +703,8 @@ class SamploRange():
         # (Only the original receives the event)
         if event:
             if self.select_multiple:
-                global samploranges
-                for srange in samploranges:
-                    if srange != self and srange.selected:
+                for srange in selection:
+                    if srange != self:
                         srange.button_release()
 
         global last_touched
@@ -502,9 +712,9 @@ class SamploRange():
 
     # Helper function to get event info.
     def event_info(self, event):
-        c = event.widget
-        x, y = c.winfo_x(), c.winfo_y()
-        w, h = c.winfo_width(), c.winfo_height()
+        c = self.window
+        _, y, w, h = self.geometry
+        x = int(width_per_note * self.start)
         x_add, y_add = event.x, event.y
         x_max, y_max = self.window.winfo_width(), self.window.winfo_height()
         return c, x, y, w, h, x_add, y_add, x_max, y_max
@@ -518,16 +728,11 @@ class SamploRange():
             self.in_motion = True
             self.mouse_start_x = self.mouse_current_x
             self.mouse_start_y = self.mouse_current_y
-            self.resize_start = self.start
-            self.resize_end = self.end
 
             # We need to set the resize begin values for all
-            # sample ranges to make resizing with multiple
+            # selected sample ranges to make resizing with multiple
             # selections work properly.
-            global samploranges
-            for srange in samploranges:
-                srange.resize_start = srange.start
-                srange.resize_end = srange.end
+            range_store.begin_resize([self.row] + [s.row for s in selection])
 
             # Check if we are grabbing the resize handles.
             resize_width = resize_handle_width
@@ -565,21 +770,20 @@ class SamploRange():
 
     # # Resizing and moving # #
 
-    def check_change(self, amount):
+    def check_change(self):
         global render_groups, name_by_general_midi
 
-        if amount != self.prev_amount:
+        # The groups are kept sorted, so they should know about every
+        # change in position.
+        if (self.start, self.end) != self.group_range:
             move_through_groups(render_groups, self)
             if name_by_general_midi.get():
-                self.draw_name()
-
-        self.prev_amount = amount
+                mark_dirty(self, color=False)
 
     # Resize and move the selected note ranges such that
     # the do not overlap.
     def resize_alt(self, event):
-        global samploranges
-        selected = [s for s in samploranges if s.selected]
+        selected = list(selection)
 
         if len(selected) == 0:
             selected = [self]
@@ -597,16 +801,8 @@ class SamploRange():
         if scale <= 0:
             return
 
-        for srange in selected:
-            note_range = [(srange.resize_start - base_note) * scale + base_note,
-                          (srange.resize_end + 1 - base_note) * scale + base_note]
-            start = int(min(note_range))
-            end = int(max(note_range) - 1)
-            width = end - start
-
-            if srange.start != start or srange.end != end:
-                srange.move_value(start - srange.start)
-                srange.resize_value(1, width - (srange.resize_end - srange.start))
+        changed = range_store.stretch([s.row for s in selected], base_note, scale)
+        ranges_changed([selected[i] for i in changed])
 
     # Resize the note range, based on TKinter mouse event.
     def resize(self, event):
@@ -626,36 +822,16 @@ class SamploRange():
                             math.floor(x_new / width_per_note))
             resize_amount = start_new
 
-        self.resize_value(self.resize_side, resize_amount)
-
         # Forward the changes to the other instances of the selected group.
+        sranges = [self]
         if self.select_multiple:
-            global samploranges
-            for srange in samploranges:
-                if srange != self and srange.selected:
-                    srange.resize_value(self.resize_side, resize_amount)
+            sranges += [s for s in selection if s != self]
+        resize_ranges(sranges, self.resize_side, resize_amount)
 
 
-    # Move based on given amount.
+    # Resize based on given amount.
     def resize_value(self, side, amount):
-        # Move the block if resizing on the left.
-        if side > 0:
-            self.end = max(self.start, self.resize_end + amount)
-        else:
-            self.start = min(self.end, self.resize_start + amount)
-            self.widget.place(x=self.start * width_per_note)
-
-        # Redraw the size.
-        self.width = int(width_per_note * (self.end - self.start + 1))
-        self.widget.configure(width=self.width - adjust_for_highlight * highlight)
-
-        self.check_change(amount)
-
-    # Replace the widget to the correct place according to its
-    # `start` and `end` values.
-    def resize_place(self):
-        self.widget.place(x=self.start * width_per_note)
-        self.widget.configure(width=self.width - adjust_for_highlight * highlight)
+        resize_ranges([self], side, amount)
 
     # Move the note range, based on TKinter mouse event.
     def move(self, event):
@@ -664,87 +840,195 @@ class SamploRange():
         x_new = x - self.mouse_current_x + event.x
         note_set = round(x_new / width_per_note)
         note_move = note_set - self.start
-        self.move_value(note_move)
 
         # Forward the changes to the other instances of the selected group.
+        sranges = [self]
         if self.select_multiple:
-            global samploranges
-            for srange in samploranges:
-                if srange != self and srange.selected:
-                    srange.move_value(note_move)
+            sranges += [s for s in selection if s != self]
+        move_ranges(sranges, note_move)
 
     # Move based on given amount.
     def move_value(self, amount):
-        # Determine the new note range
-        note_diff = self.end - self.start
-        self.start += amount
-        self.end = self.start + note_diff
-
-        # Redraw
-        self.widget.place(x=self.start * width_per_note)
-
-        self.check_change(amount)
+        move_ranges([self], amount)
 
 
     # # Solo/mute # #
-    def set_mute(self, mute):
+    # Set `update` to False to leave updating REAPER to the caller.
+    def set_mute(self, mute, update=True):
         self.mute = mute
-        self.update_reaper_mute()
+        if update:
+            self.update_reaper_mute()
         self.redraw()
 
-    def set_solo(self, solo):
+    def set_solo(self, solo, update=True):
         self.solo = solo
-        self.update_reaper_mute()
+        if update:
+            self.update_reaper_mute()
         self.redraw()
 
+    # Whether the FX should be enabled in REAPER, given whether any
+    # of the note ranges are soloed.
+    def reaper_enabled(self, soloing):
+        return self.solo or (not soloing and not self.mute)
+
     # # REAPER communication # #
     def update_reaper_mute(self):
         global samploranges
 
-        if self.solo:
-            self.fx.enable()
-        else:
-            if self.mute:
-                self.fx.disable()
-            else:
-                self.fx.enable()
+        if self.fx:
+            soloing = any(s.solo for s in samploranges)
+            reaper_call(set_enabled_in_reaper, [(self.fx, self.reaper_enabled(soloing))])
 
-    @rp.inside_reaper()
     def update_reaper(self):
         if self.fx:
+            name = None
             if self.changed_name:
                 name = self.current_name
                 if name.startswith(solo_prefix):
                     name = name[len(solo_prefix):]
                 elif name.startswith(mute_prefix):
                     name = name[len(mute_prefix):]
-                set_fx_name(self.fx, name)
+                self.fx_name = name
                 self.changed_name = False
 
-            with rp.undo_block('Multi-Sampler: update note range'):
-                params = self.fx.params
-                difference = self.start - round(params["Note range start"] * 127)
+            queue_reaper_write(self, name)
 
-                params["Note range start"] = self.start / 127
-                params["Note range end"] = self.end / 127
-                params["Pitch for start note"] += difference / 160
+# # # Write-back buffer # # #
+
+# Changes to the note ranges are collected, and written to REAPER together
+# once no new changes came in for `write_back_delay` ms. Moving many sample
+# ranges at once thus results in a single batch, and a single undo point.
+pending_writes = {}
+write_back_job = None
+def queue_reaper_write(srange, name=None):
+    global root, pending_writes, write_back_job
+
+    # Don't forget an earlier name change.
+    if name != None or not srange in pending_writes:
+        pending_writes[srange] = name
+
+    if write_back_job:
+        root.after_cancel(write_back_job)
+    write_back_job = root.after(write_back_delay, flush_reaper_writes)
+
+# Write all pending changes to REAPER. Whether a sample range is already up
+# to date is checked in REAPER, since it might have changed there meanwhile
+# (for instance by undo).
+def flush_reaper_writes():
+    global root, pending_writes, write_back_job, samploranges
+
+    if write_back_job:
+        root.after_cancel(write_back_job)
+        write_back_job = None
+
+    writes = []
+    current = set(samploranges)
+    for srange, name in pending_writes.items():
+        if not srange.fx or not srange in current:
+            continue
+
+        writes.append((srange.fx, srange.start, srange.end, name))
+
+    pending_writes = {}
+    if writes:
+        reaper_call(write_ranges_in_reaper, writes)
+
+# Update the note ranges (and possibly the names) of the FX in REAPER.
+# Each write is the tuple (fx, start, end, name). The current note range
+# is read from REAPER first, and nothing is done (not even an undo point)
+# if everything is up to date. The names are changed with a single chunk
+# edit per track. The parameters are set by index, and only if they
+# changed. Runs on the REAPER worker.
+def write_ranges_in_reaper(writes):
+    api = rp.reascript_api
+    changes = []
+    for fx, start, end, name in writes:
+        fx = resolve_fx(fx)
+        if not fx:
+            continue
+
+        old_start = round(127 * api.TrackFX_GetParamNormalized(fx.parent_id, fx.index,
+                                                              param_note_start))
+        old_end = round(127 * api.TrackFX_GetParamNormalized(fx.parent_id, fx.index,
+                                                            param_note_end))
+        if start != old_start or end != old_end or name != None:
+            changes.append((fx, old_start, old_end, start, end, name))
+
+    if changes:
+        with rp.undo_block('Multi-Sampler: update note range'):
+            write_range_changes(changes)
+
+def write_range_changes(changes):
+    api = rp.reascript_api
+    chunks = {}
+    for fx, _, _, _, _, name in changes:
+        if name != None:
+            if not fx.parent_id in chunks:
+                chunks[fx.parent_id] = TrackChunk(fx.parent_id)
+            chunk = chunks[fx.parent_id]
+            chunk.set_name(chunk.find(fx), name)
+
+    for chunk in chunks.values():
+        chunk.commit()
+
+    for fx, old_start, old_end, start, end, name in changes:
+        # Move the pitch along with the start note.
+        if start != old_start:
+            api.TrackFX_SetParamNormalized(fx.parent_id, fx.index,
+                                           param_note_start, start / 127)
+            pitch = api.TrackFX_GetParamNormalized(fx.parent_id, fx.index,
+                                                   param_pitch_start)
+            api.TrackFX_SetParamNormalized(fx.parent_id, fx.index, param_pitch_start,
+                                           pitch + (start - old_start) / 160)
+
+        if end != old_end:
+            api.TrackFX_SetParamNormalized(fx.parent_id, fx.index,
+                                           param_note_end, end / 127)
+
+# Set the enabled state for a list of (fx, enabled) tuples.
+# Runs on the REAPER worker.
+def set_enabled_in_reaper(fx_states, undo_name=None):
+    with rp.undo_block(undo_name or 'Multi-Sampler: toggle mute'):
+        for fx, enabled in fx_states:
+            fx = resolve_fx(fx)
+            if not fx:
+                continue
+            if enabled:
+                fx.enable()
+            else:
+                fx.disable()
+
+# Open or close the user interfaces of the given FX. Runs on the REAPER worker.
+def open_ui_in_reaper(fx):
+    fx = resolve_fx(fx)
+    if fx:
+        fx.open_ui()
+
+def close_ui_in_reaper(fxs):
+    for fx in resolve_fxs(fxs):
+        fx.close_ui()
 
 # # # Layered rendering. # # #
 
 # The group class describes a selection of overlapping SamploRanges.
-# It is used only for the `create_layers` functionality, which
-# describes a way to render the SamploRanges without overlap.
+# It is used to render the SamploRanges in layers, without overlap.
+# Groups never overlap each other, so `render_groups` is kept sorted by
+# note, and the groups touching a note range are found with a binary
+# search (see `find_groups`).
 class SamploGroup():
     def __init__(self):
         self.sranges = []
         self.start = float('inf')
         self.end = -float('inf')
-        self.layers = None
+        self.layers = {}
+        self.layer_count = 0
 
     def add(self, srange):
         self.sranges.append(srange)
         self.start = min(self.start, srange.start)
         self.end = max(self.end, srange.end)
+        srange.render_group = self
+        srange.group_range = (srange.start, srange.end)
 
     def remove(self, srange):
         try:
@@ -756,20 +1040,23 @@ class SamploGroup():
             self.start = min(x.start for x in self.sranges)
             self.end = max(x.end for x in self.sranges)
 
-    # Determines valid subgroups in the group, and returns them.
+    # Determines valid subgroups in the group, and returns them in order.
+    # A sweep from left to right starts a new group whenever a range starts
+    # after all ranges before it ended.
     # Should always be called after `remove` has been called.
     def split(self):
         groups_split = []
 
-        for srange in self.sranges:
-            insert_in_groups(groups_split, srange, False)
+        for srange in sorted(self.sranges, key=lambda x: x.start):
+            if not groups_split or srange.start > groups_split[-1].end:
+                groups_split.append(SamploGroup())
+            groups_split[-1].add(srange)
 
         return groups_split
 
     def merge(self, group):
-        self.sranges += group.sranges
-        self.start = min(self.start, group.start)
-        self.end = max(self.end, group.end)
+        for srange in group.sranges:
+            self.add(srange)
 
     def intersect(self, srange):
         if srange.end < self.start:
@@ -778,268 +1065,1062 @@ class SamploGroup():
             return False
         return True
 
+    # Assign the layers with a sweep from left to right: every range is put
+    # in the lowest layer which is free at its start. This uses as few
+    # layers as possible.
     def create_layers(self):
-        self.layers = []
-
-        self.sranges.sort(key=lambda x: x.start)
-        group_todo = list(self.sranges)
-
-        # Keep creating ranges until no ranges are left.
-        while group_todo:
-            layer = [group_todo[0]]
-            group_todo = group_todo[1:]
-
-            # Create a layer of non-overlapping (but as close together
-            # as possible) closest ranges. And remove the added ranges
-            # from the todo list.
-            for srange in list(group_todo):
-                if srange.start > layer[-1].end:
-                    layer.append(srange)
-                    group_todo.remove(srange)
-
-            self.layers.append(layer)
+        self.layers = {}
+        self.layer_count = 0
+        layer_ends = []
+        layers_free = []
+
+        for srange in sorted(self.sranges, key=lambda x: (x.start, x.end)):
+            # Free the layers of the ranges which ended.
+            while layer_ends and layer_ends[0][0] < srange.start:
+                heapq.heappush(layers_free, heapq.heappop(layer_ends)[1])
+
+            if layers_free:
+                layer = heapq.heappop(layers_free)
+            else:
+                layer = self.layer_count
+                self.layer_count += 1
 
-    def get_layer(self, srange):
-        for n, layer in enumerate(self.layers):
-            if srange in layer:
-                return n
-        return -1
+            heapq.heappush(layer_ends, (srange.end, layer))
+            self.layers[srange] = layer
 
+    # Update the layers of the ranges, and redraw only the ranges of which
+    # the layer, layer count or geometry changed. Returns those ranges.
     def update_srange_layers(self):
         self.create_layers()
+        max_height = range_height()
+        changed = []
         for srange in self.sranges:
             srange.render_group = self
-            srange.layer_count = len(self.layers)
-            srange.layer = self.get_layer(srange)
-            srange.redraw()
-
-
-def insert_in_groups(groups, srange, update_srange=True):
-    intersect = False
-
-    # Try to insert into any of the existing groups.
-    for group in groups:
-        if group.intersect(srange):
-            group.add(srange)
-            intersect = True
-
-            if update_srange:
-                srange.render_group = group
-            break
+            layer = self.layers[srange]
+            if srange.layer != layer or srange.layer_count != self.layer_count:
+                srange.layer_count = self.layer_count
+                srange.layer = layer
+                changed.append(srange)
+            elif srange.get_geometry(max_height) != srange.geometry:
+                changed.append(srange)
+
+        for srange in changed:
+            mark_dirty(srange, color=False)
+        return changed
+
+
+# Returns the index of the first group which ends at or after the note.
+def bisect_groups(groups, note):
+    low, high = 0, len(groups)
+    while low < high:
+        middle = (low + high) // 2
+        if groups[middle].end < note:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+# Returns the indices (first, last) of the groups which overlap with the
+# note range, such that `groups[first:last]` are those groups.
+def find_groups(groups, start, end):
+    first = bisect_groups(groups, start)
+    last = first
+    while last < len(groups) and groups[last].start <= end:
+        last += 1
+    return first, last
+
+# Insert the range in the groups, merging all groups it overlaps with.
+def insert_in_groups(groups, srange):
+    first, last = find_groups(groups, srange.start, srange.end)
+
+    group_new = SamploGroup()
+    for group in groups[first:last]:
+        group_new.merge(group)
+    group_new.add(srange)
+    groups[first:last] = [group_new]
+
+    group_new.update_srange_layers()
+
+# Remove the range from its group, which potentially splits the group.
+# Returns the groups it was split into. Set `update` to False to leave
+# updating their layers to the caller.
+def remove_from_groups(groups, srange, update=True):
+    group = srange.render_group
+    srange.render_group = None
+    srange.group_range = None
+    if group is None:
+        return []
 
-    # Create new group if necessary.
-    if not intersect:
-        group_new = SamploGroup()
-        group_new.add(srange)
-        groups.append(group_new)
+    # The group is found by its own note range, since the range may
+    # already have moved.
+    i = bisect_groups(groups, group.start)
+    if i >= len(groups) or groups[i] is not group:
+        i = groups.index(group)
 
-        if update_srange:
-            srange.render_group = group_new
+    group.remove(srange)
+    groups_split = group.split()
+    groups[i:i + 1] = groups_split
 
+    # Update the layer information in the sranges.
+    if update:
+        for group in groups_split:
+            group.update_srange_layers()
+    return groups_split
+
+# Returns the sample range at the given position on the canvas, or None.
+# Only the group at the note under the position is searched.
+def srange_at(x, y):
+    global render_groups
+    note = math.floor(x / width_per_note)
+    first, last = find_groups(render_groups, note, note)
+    for group in render_groups[first:last]:
+        for srange in group.sranges:
+            if srange.geometry and srange.contains(x, y):
+                return srange
+    return None
 
 # The logic for updating the groups after updating the position
-# of the specified SamploRange. It has the following steps:
-#  (1) First, the range is removed from the current group
-#  (2) This potentially splits the group, which is done in the
-#      first section.
-#  (3) Then the range is reinserted.
-#  (4) Finally, it merges all groups that overlap with the (new)
-#      group of the range
+# of the specified SamploRange. The range is removed from its current
+# group, which is split if necessary, and then inserted again, merging
+# the groups it now overlaps with. Only the groups around the old and
+# new position of the range are touched, and the layers of each of those
+# are updated once.
 def move_through_groups(groups, srange):
-    if srange.render_group is None or srange.render_group in groups:
-        print
+    groups_split = remove_from_groups(groups, srange, False)
+    insert_in_groups(groups, srange)
+
+    # Update the split groups which were not merged again.
+    for group in groups_split:
+        if group.sranges[0].render_group is group:
+            group.update_srange_layers()
+
+
+# # # Sample range events # # #
+
+# All sample ranges are drawn on the same canvas, so the mouse events of
+# the canvas are passed on to the range under the cursor. As with widgets,
+# the range which was pressed keeps getting the events until the button is
+# released. The position is made relative to the range. Its horizontal
+# position follows from its notes, since drawing may lag behind.
+class RangeEvent():
+    def __init__(self, event, srange):
+        _, y_pos, _, _ = srange.geometry
+        self.x = event.x - int(width_per_note * srange.start)
+        self.y = event.y - y_pos
+
+# Presses on the pianoroll keys play the note until release.
+grabbed_range = None
+pressed_note = None
+def range_press(event, action):
+    global grabbed_range, pressed_note
+    if zoom_settle:
+        zoom_done()
+
+    pressed_note = pianoroll_note(event.x, event.y)
+    if pressed_note != None:
+        play_note(pressed_note, True, event)
+        return
 
+    grabbed_range = srange_at(event.x, event.y)
+    if not grabbed_range:
+        deselect_all()
+        return
+
+    grabbed_range.motion(RangeEvent(event, grabbed_range))
+    action(grabbed_range)
+
+def range_drag(event):
+    defer_motion(range_motion, event)
+
+def range_motion(event):
+    if grabbed_range:
+        grabbed_range.mouse(RangeEvent(event, grabbed_range))
+
+def range_release(event):
+    global grabbed_range, pressed_note
+    flush_motion()
+    if pressed_note != None:
+        play_note(pressed_note, False, event)
+        pressed_note = None
+    if grabbed_range:
+        grabbed_range.button_release(RangeEvent(event, grabbed_range))
+    grabbed_range = None
+
+# # # Redrawing # # #
+
+# Changes to the sample ranges are not drawn right away, but collected and
+# drawn together once Tk is idle, so at most once per frame. Mouse motion
+# is handled there as well: when motion events come in faster than that,
+# only the latest one is handled.
+dirty_ranges = {}
+pending_motion = None
+redraw_scheduled = False
+
+def schedule_redraw():
+    global root, redraw_scheduled
+    if not redraw_scheduled:
+        redraw_scheduled = True
+        root.after_idle(flush_redraw)
+
+# Mark the range to be laid out (`place`) and recolored (`color`) on the
+# next redraw.
+def mark_dirty(srange, place=True, color=True):
+    global dirty_ranges
+    place_old, color_old = dirty_ranges.get(srange, (False, False))
+    dirty_ranges[srange] = (place or place_old, color or color_old)
+    schedule_redraw()
+
+# Handle the motion event on the next redraw, instead of the motion event
+# which was still waiting.
+def defer_motion(handler, event):
+    global pending_motion
+    pending_motion = (handler, event)
+    schedule_redraw()
+
+def flush_motion():
+    global pending_motion
+    if pending_motion:
+        handler, event = pending_motion
+        pending_motion = None
+        handler(event)
+
+def flush_redraw():
+    global dirty_ranges, redraw_scheduled
+    redraw_scheduled = False
+    flush_motion()
+
+    sranges, dirty_ranges = dirty_ranges, {}
+    max_height = range_height() if sranges else 0
+    for srange, (place, color) in sranges.items():
+        if place:
+            srange.place(max_height)
+        if color:
+            srange.draw_color()
+
+
+# # # Tooltips # # #
+
+# A single tooltip for the whole window. Widgets register their message,
+# either a string or a function returning one, which is only evaluated
+# when shown. The hovered widget is looked up from the cursor position, so
+# there is at most one pending timer.
+class TooltipManager():
+    def __init__(self):
+        self.messages = {}
+        self.delays = {}
+        self.widget = None
+        self.timer = None
+        self.tip = None
+        self.label = None
+        self.position = (0, 0)
+
+    def add(self, widget, msg, delay=None):
+        self.messages[widget] = msg
+        if delay != None:
+            self.delays[widget] = delay
+
+    # Bound to the tag of the toplevel, which all its widgets have. On the
+    # "all" tag, the more specific bindings (right click, scrolling) would
+    # be used instead.
+    def bind(self, root):
+        root.bind("<Motion>", self.motion, add="+")
+        root.bind("<Leave>", self.motion, add="+")
+        root.bind("<ButtonPress>", lambda e: self.hide(), add="+")
+        root.bind("<MouseWheel>", lambda e: self.hide(), add="+")
+
+    # Returns the registered widget under the cursor (or one of its parents).
+    def target(self, event):
+        try:
+            widget = root.winfo_containing(event.x_root, event.y_root)
+        except KeyError:
+            return None
+        while widget and not widget in self.messages:
+            widget = widget.master
+        return widget
 
-    assert srange.render_group is None or srange.render_group in groups
+    def motion(self, event):
+        self.position = (event.x_root, event.y_root)
+        widget = self.target(event)
+        if widget != self.widget:
+            self.hide()
+            self.widget = widget
+            if widget:
+                delay = self.delays.get(widget, tooltip_delay)
+                self.timer = root.after(int(delay * 1000), self.show)
+        elif self.tip and self.tip.winfo_viewable():
+            self.show()
 
-    # Remove from the current group, split the group if necessary.
-    if srange.render_group:
-        srange.render_group.remove(srange)
+    def show(self):
+        self.timer = None
+        msg = self.messages.get(self.widget)
+        text = msg() if callable(msg) else msg
+        if not text:
+            self.hide()
+            return
 
-        if len(srange.render_group.sranges) == 0:
-            # Remove if the group is empty.
-            groups.remove(srange.render_group)
+        if not self.tip:
+            self.tip = tk.Toplevel(root)
+            self.tip.withdraw()
+            self.tip.overrideredirect(True)
+            self.tip.attributes("-topmost", True)
+            self.label = tk.Label(self.tip, justify="left", bg=background_color,
+                                  fg=foreground_color, relief="solid",
+                                  borderwidth=1, padx=4, pady=2)
+            self.label.pack()
+
+        if self.label.cget("text") != text:
+            self.label.config(text=text)
+        x, y = self.position
+        self.tip.geometry(f"+{x + 10}+{y + 10}")
+        self.tip.deiconify()
+
+    # Hide the tooltip. It shows again after moving to another widget.
+    def hide(self):
+        if self.timer:
+            root.after_cancel(self.timer)
+            self.timer = None
+        if self.tip:
+            self.tip.withdraw()
+
+tooltips = TooltipManager()
+
+# The tooltip of the canvas, which depends on what is under the cursor.
+def range_tooltip():
+    x = window.winfo_pointerx() - window.winfo_rootx()
+    y = window.winfo_pointery() - window.winfo_rooty()
+    note = pianoroll_note(x, y)
+    if note != None:
+        return (f"Press to send MIDI note {note} to reaper. "
+                "\n\nVertical position determines velocity.")
+    if srange_at(x, y):
+        return ("Drag to move.\n"
+                "Drag edges to resize.\n"
+                "Alt+drag to stretch.\n\n"
+                "Click to open UI\n"
+                "Ctrl+click to add to\nselection.")
+    return "Right click+drag for\nrectangle select."
+
+# The length in pixels of texts, by (font, text). Measuring text is slow in
+# Tk, so every text is measured only once (until the font changes).
+text_lengths = {}
+def text_length(font, text):
+    key = (str(font), text)
+    length = text_lengths.get(key)
+    if length == None:
+        # Do not keep the lengths of all texts ever measured.
+        if len(text_lengths) > 10000:
+            text_lengths.clear()
+        length = text_lengths[key] = font.measure(text)
+    return length
+
+# Returns the longest start of the text which fits in the given length.
+def fit_text(text, length):
+    if text_length(range_font, text) <= length:
+        return text
+
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if text_length(range_font, text[:middle]) <= length:
+            low = middle
         else:
-            # Split into new groups if necessary.
-            groups_split = srange.render_group.split()
-            if len(groups_split) > 1:
-                groups.remove(srange.render_group)
-                groups += groups_split
-
-                # Update the layer information in the sranges.
-                for group in groups_split:
-                    group.update_srange_layers()
-            else:
-                srange.render_group.update_srange_layers()
-
-    srange.render_group = None
+            high = middle - 1
+    return text[:low]
+
+# Returns None if the name fits horizontally in a range of the given size,
+# and otherwise the part of the name which fits vertically. Remembered by
+# (name, width, height), so redraws do not measure anything.
+name_layouts = {}
+def name_layout(name, width, height):
+    key = (name, width, height)
+    if not key in name_layouts:
+        # Do not keep the layouts of all sizes ever used.
+        if len(name_layouts) > 10000:
+            name_layouts.clear()
+
+        if text_length(range_font, name) + 5 > width:
+            name_layouts[key] = fit_text(name, height - 4)
+        else:
+            name_layouts[key] = None
+    return name_layouts[key]
+
+# Forget all measured texts. Tk sends <<TkWorldChanged>> to every widget
+# when a named font is reconfigured.
+def fonts_changed(event=None):
+    text_lengths.clear()
+    name_layouts.clear()
+
+
+# # # REAPER worker # # #
+
+# All communication with REAPER happens on a single background thread, so
+# the GUI stays responsive while REAPER is busy. Commands are executed in
+# order, each inside of REAPER (see `rp.inside_reaper`). When a command has
+# a callback, it is called with the result on the GUI thread.
+# Set `hold` to False for commands which should not run inside of REAPER,
+# such as reconnecting. If a command fails, the callback is called with a
+# `ReaperError` instead, so that nothing keeps waiting for the result.
+class ReaperWorker(threading.Thread):
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.commands = queue.Queue()
+        self.results = queue.Queue()
 
-    # Insert into groups again.
-    if not srange.render_group:
-        insert_in_groups(groups, srange)
+    def call(self, func, *args, callback=None, hold=True, **kwargs):
+        self.commands.put((func, args, kwargs, callback, hold))
 
-    assert srange.render_group != None
+    def stop(self):
+        self.commands.put(None)
 
-    # Merge groups if necessary.
-    for group in list(groups):
-        if group == srange.render_group:
-            continue
+    def run(self):
+        global root
+        while (command := self.commands.get()) != None:
+            func, args, kwargs, callback, hold = command
+            fx_cache.new_command()
+            try:
+                if hold:
+                    with rp.inside_reaper():
+                        result = func(*args, **kwargs)
+                else:
+                    result = func(*args, **kwargs)
+            except Exception as e:
+                import traceback
+                traceback.print_exc()
+                result = ReaperError(e)
+
+            if callback:
+                self.results.put((callback, result))
+
+                # Wake up the GUI thread. If that fails, the results are
+                # picked up by `poll_reaper_results`.
+                try:
+                    root.after_idle(process_reaper_results)
+                except (RuntimeError, tk.TclError):
+                    pass
 
-        # Merge if the groups overlap.
-        if group.intersect(srange.render_group):
-            group.merge(srange.render_group)
+class ReaperError():
+    def __init__(self, exception):
+        self.exception = exception
 
-            groups.remove(srange.render_group)
+reaper_worker = None
+def reaper_call(func, *args, **kwargs):
+    global reaper_worker, pending_writes
 
-            # Update all references.
-            for s in srange.render_group.sranges:
-                s.render_group = group
+    # Pending note range changes go first, so the command sees them.
+    if pending_writes:
+        flush_reaper_writes()
 
-    # Update the layer information in the sranges.
-    srange.render_group.update_srange_layers()
+    reaper_worker.call(func, *args, **kwargs)
 
+# Call the callbacks of all finished REAPER commands.
+def process_reaper_results():
+    global reaper_worker
+    while True:
+        try:
+            callback, result = reaper_worker.results.get_nowait()
+        except queue.Empty:
+            return
 
-# # # Setup functions # # #
+        try:
+            callback(result)
+        except Exception:
+            import traceback
+            traceback.print_exc()
+
+# Pick up the results periodically on the GUI thread, independent of the
+# sync loop, which itself waits on results.
+def poll_reaper_results():
+    global root
+    process_reaper_results()
+    root.after(results_interval, poll_reaper_results)
+
+def perform_action(action_id):
+    rp.Project().perform_action(action_id)
+
+
+# # # FX identity # # #
+
+# An FX which is identified by its GUID. The index is only a hint: on the
+# REAPER worker, `resolve_fx` returns a handle which points to the right FX.
+# The GUID stays the same when other FX are added, deleted or moved.
+class FXHandle(rp.FX):
+    def __init__(self, parent_id, index, guid):
+        super().__init__(parent_id=parent_id, index=index)
+        self.guid = guid
+
+# Keeps the GUIDs of the FX on every track, in order, which are read from
+# the track state chunk. This only happens again when the amount of FX on
+# the track changed, which is checked once per command, or when an FX is
+# not at its cached index (see `index`). Changes made by this script are
+# applied directly. Only used on the REAPER worker.
+# Whether an FX is a ReaSamplOmatic5000 is also remembered, by GUID.
+class FXCache():
+    def __init__(self):
+        self.tracks = {}
+        self.checked = set()
+        self.verified = set()
+        self.samplomatic = {}
+
+    # Called by the REAPER worker before every command.
+    def new_command(self):
+        self.checked.clear()
+        self.verified.clear()
+
+    # Read the GUIDs from the (given) state chunk of the track, which can
+    # also be a `TrackChunk`.
+    def update(self, track_id, chunk=None):
+        if not isinstance(chunk, TrackChunk):
+            chunk = TrackChunk(track_id, chunk)
+        self.set_chain(track_id, parse_fx_chain(chunk))
+        self.checked.add(track_id)
+        self.verified.update(self.tracks[track_id])
+
+    # Set the FX of the track from the result of `parse_fx_chain`.
+    def set_chain(self, track_id, fx_chain):
+        self.tracks[track_id] = [guid for _, _, guid, _ in fx_chain]
+        for _, _, guid, plugin in fx_chain:
+            if not guid in self.samplomatic:
+                self.samplomatic[guid] = is_samplomatic_plugin(plugin)
+
+    # Returns the GUIDs of all FX on the track.
+    def guids(self, track_id):
+        if not track_id in self.checked:
+            count = rp.reascript_api.TrackFX_GetCount(track_id)
+            guids = self.tracks.get(track_id)
+            if guids == None or len(guids) != count:
+                self.update(track_id)
+            self.checked.add(track_id)
+        return self.tracks[track_id]
+
+    # Returns the index of the FX, or None if it is not on the track. FX
+    # can be reordered without changing their amount, so the cached index
+    # is checked in REAPER, once per FX per command.
+    def index(self, track_id, guid):
+        guids = self.guids(track_id)
+        if not guid in guids:
+            return None
+
+        index = guids.index(guid)
+        if not guid in self.verified:
+            if rp.reascript_api.TrackFX_GetFXGUID(track_id, index) != guid:
+                self.update(track_id)
+                return self.index(track_id, guid)
+            self.verified.add(guid)
+        return index
+
+    # Register an FX added by this script. If the track is not up to date,
+    # it is simply read again later.
+    def insert(self, track_id, index, guid):
+        if track_id in self.checked:
+            self.tracks[track_id].insert(index, guid)
+        else:
+            self.tracks.pop(track_id, None)
 
-# Helper function for below. Find the location in the chunk
-# corresponding to the given FX. Start search at `loc`.
-def find_fx_in_chunk(chunk, fx):
-    loc = chunk.find('<FXCHAIN')
-
-    # Go through the FX until arriving at the correct one.
-    for _ in range(fx.index + 1):
-        loc = chunk.find('\nBYPASS ', loc + 1)
-    return loc
-
-fx_mode_sample_data = "AAAAAAAAAPA/AAAAAAAA4D8AAAAAAADwPwAAAAAAAAAA" \
-                      "AAAAAAAA8D+amZmZmZmxP83MzMzMzOs/AAAAAAAAAAAc" \
-                      "x3Ecx3HcP/yp8dJNYkA//Knx0k1iQD8AAAAAAAAAAAAA" \
-                      "AAAAAAAAAAAAAAAAAAAAAAAAAADwPwAAAAAAAOA/AQAA" \
-                      "AAAAAAAAAAAAAAAAAAAA8D9AAAAAVVVVVVVVxT//////" \
-                      "CAQCgUAggD8AAAAAAADwPwAAAAAAAPA/AAAAAAAAAAAA" \
-                      "AAAAAAAAAAAAAAAA"
-
-fx_mode_note_data = "AAAAAAAAAPA/AAAAAAAA4D8AAAAAAADwPwAAAAAAAAAAAAAAA" \
-                    "AAA8D+amZmZmZmxP83MzMzMzOs/AAAAAAAAAAAcx3Ecx3HcP/" \
-                    "yp8dJNYkA//Knx0k1iQD8AAAAAAAAAAAAAAAAAAAAAAAAAAAA" \
-                    "AAAAAAAAAAADwPwAAAAAAAOA/AgAAAAAAAAAAAAAAAAAAAAAA" \
-                    "8D9AAAAAVVVVVVVVxT//////CAQCgUAggD8AAAAAAADwPwAAA" \
-                    "AAAAPA/AAAAAAAAAAAAAAAAAAAAAAAAAAAA"
-
-# Function which changes the mode of ReaSamplOmatic5000 instance
-# to `Note (Semitone shifted)`. Also resets all other parameters,
-# so beware!
-# Perhaps a ReaScript API function will one day exists for this.
-def set_fx_mode(fx):
-    track = fx.parent
-    chunk = rp.reascript_api.GetTrackStateChunk(track.id, '', 2**25, False)[2]
-
-    loc = find_fx_in_chunk(chunk, fx)
-
-    for _ in range(3):
-        loc = chunk.find("\n", loc + 1)
-
-    data_start = loc + 1
-    data_end = chunk.find("\n", loc + 1)
-
-    chunk_new = chunk[:data_start] + fx_mode_note_data + chunk[data_end:]
-
-    # Update the chunk.
-    rp.reascript_api.SetTrackStateChunk(track.id, chunk_new, False)
-
-# Helper function for below. Finds the first FX name in RPPXML of the
-# track, starting at location `loc`.
-def find_fx_name(chunk, loc):
-    token_number = 4
-
-    # Go to the next token.
-    for _ in range(token_number):
-        # Go to the start of the token
-        loc = chunk.find(" ", loc + 1)
-        name_start = loc + 1
-
-        # Go to the end.
-        if chunk[name_start] == '"':
-            loc = chunk.find('"', loc + 2)
+    # Forget an FX deleted by this script.
+    def remove(self, track_id, guid):
+        if track_id in self.checked:
+            self.tracks[track_id].remove(guid)
         else:
-            loc = chunk.find(' ', loc + 1) - 1
+            self.tracks.pop(track_id, None)
+
+    def invalidate(self, track_id):
+        self.tracks.pop(track_id, None)
+        self.checked.discard(track_id)
+
+fx_cache = FXCache()
+
+# Returns a handle with the current index of the FX, or None if the FX does
+# not exist anymore. The given handle is shared with the GUI thread, so it
+# is left as it is. Runs on the REAPER worker.
+def resolve_fx(fx):
+    index = fx_cache.index(fx.parent_id, fx.guid)
+    if index == None:
+        return None
+    return FXHandle(fx.parent_id, index, fx.guid)
+
+def resolve_fxs(fxs):
+    return [fx for fx in map(resolve_fx, fxs) if fx]
+
+# Register an FX that was just added at the given index, and return a
+# handle to it. Runs on the REAPER worker.
+# Only used for ReaSamplOmatic5000 instances.
+def new_fx_handle(track_id, index):
+    guid = rp.reascript_api.TrackFX_GetFXGUID(track_id, index)
+    fx_cache.insert(track_id, index, guid)
+    fx_cache.samplomatic[guid] = True
+    return FXHandle(track_id, index, guid)
+
+
+# # # Track state chunks # # #
+
+# Split a line of RPPXML into its tokens. Tokens are separated by spaces,
+# and can be quoted with ", ' or `.
+def rpp_tokens(line):
+    tokens = []
+    loc = 0
+
+    while loc < len(line):
+        if line[loc] == ' ':
+            loc += 1
+            continue
 
-        name_end = loc + 1
+        if line[loc] in '"\'`':
+            end = line.find(line[loc], loc + 1)
+            if end < 0:
+                end = len(line)
+            tokens.append(line[loc + 1:end])
+            loc = end + 1
+        else:
+            end = line.find(' ', loc)
+            if end < 0:
+                end = len(line)
+            tokens.append(line[loc:end])
+            loc = end
+
+    return tokens
+
+# The inverse of the above: quote the token if necessary.
+def rpp_quote(token):
+    if token and not any(c in token for c in ' "\'`'):
+        return token
+    for quote in '"\'`':
+        if not quote in token:
+            return f"{quote}{token}{quote}"
+    return '"' + token.replace('"', "'") + '"'
+
+# Returns the state chunk of the track with the given id. The buffer is
+# sized from the length of the chunk the previous time, and grown if the
+# chunk does not fit.
+chunk_sizes = {}
+def get_track_chunk(track_id):
+    global chunk_sizes
+    size = max(2**16, 2 * chunk_sizes.get(track_id, 0))
+
+    while True:
+        result = rp.reascript_api.GetTrackStateChunk(track_id, '', size, False)
+        chunk = result[2]
+        if result[0] and len(chunk) < size - 1:
+            break
+        if size >= 2**28:
+            break
+        size *= 2
+
+    chunk_sizes[track_id] = len(chunk)
+    return chunk
+
+# A single FX in a `TrackChunk`: the lines from its `BYPASS` line up to
+# the next FX. The numbers are line numbers within these lines: of the
+# first line of the plugin block, the closing `>` of that block, and the
+# `FXID` line. `start` and `stop` give the location in the chunk, and are
+# None for FX which are not in the chunk yet.
+class ChunkFX():
+    def __init__(self, lines, start=None, stop=None):
+        self.lines = lines
+        self.start = start
+        self.stop = stop
+
+        self.enabled = lines[0].split()[1] == '0'
+        self.plugin = None
+        self.end = None
+        self.fxid = None
+        self.guid = None
+        self.tokens = []
+
+        depth = 0
+        for i, line in enumerate(lines):
+            line = line.strip()
+            if line.startswith('<'):
+                if depth == 0 and self.plugin == None:
+                    self.plugin = i
+                    self.tokens = rpp_tokens(line)
+                depth += 1
+            elif line == '>':
+                depth -= 1
+                if depth == 0 and self.end == None:
+                    self.end = i
+            elif depth == 0 and line.startswith('FXID '):
+                self.fxid = i
+                self.guid = line.split()[1]
+
+        # Edits, applied by `render`.
+        self.state = None
+        self.changed = False
+
+    # The index of the custom name in the plugin tokens.
+    def name_token(self):
+        return 4 if self.tokens and self.tokens[0] == '<VST' else 2
+
+    # The name as REAPER shows it: the custom name if the FX was renamed.
+    def name(self):
+        i = self.name_token()
+        custom_name = self.tokens[i] if len(self.tokens) > i else ""
+        return custom_name or (self.tokens[1] if len(self.tokens) > 1 else "")
+
+    # The file name for VSTs, and otherwise the name of the plugin.
+    def plugin_file(self):
+        if self.tokens and self.tokens[0] == '<VST' and len(self.tokens) > 2:
+            return self.tokens[2]
+        return self.tokens[1] if len(self.tokens) > 1 else ""
+
+    # A copy of the FX as it is in the chunk, without the edits. The copy is
+    # not in any chunk, and has a new GUID.
+    def copy(self):
+        fx = ChunkFX(list(self.lines))
+        fx.guid = new_guid()
+        fx.changed = True
+        return fx
+
+    # The lines of the FX with all edits applied.
+    def render(self):
+        if not self.changed:
+            return self.lines
+
+        lines = list(self.lines)
+        bypass = lines[0].split()
+        bypass[1] = '0' if self.enabled else '1'
+        lines[0] = ' '.join(bypass)
+
+        lines[self.plugin] = ' '.join([self.tokens[0]] +
+                                      [rpp_quote(t) for t in self.tokens[1:]])
+        if self.fxid != None:
+            lines[self.fxid] = f"FXID {self.guid}"
+
+        # The state of a VST. The first line of the plugin block is a header,
+        # in which the size of the state is followed by 8 bytes. The last
+        # line holds the program name. Every line is encoded separately.
+        if self.state != None:
+            header = bytearray(base64.b64decode(lines[self.plugin + 1].strip()))
+            header[-12:-8] = struct.pack('<i', len(self.state))
+            state_lines = [base64.b64encode(bytes(header)).decode()]
+            state_lines += [base64.b64encode(self.state[i:i + 210]).decode()
+                            for i in range(0, len(self.state), 210)]
+            lines[self.plugin + 1:self.end - 1] = state_lines
+
+        return lines
+
+def new_guid():
+    import uuid
+    return "{" + str(uuid.uuid4()).upper() + "}"
+
+# The state chunk of a track, with the location of every FX indexed.
+# FX can be renamed, enabled, and the plugin state of VSTs changed. Also,
+# FX can be added (as copies of other FX) and removed. These edits are
+# kept until `commit`, which writes them all with a single
+# `SetTrackStateChunk`. Chunks given by the API have no indentation.
+class TrackChunk():
+    def __init__(self, track_id, chunk=None):
+        self.track_id = track_id
+        if chunk == None:
+            chunk = get_track_chunk(track_id)
+        self.set_lines(chunk.split('\n'))
+
+    def set_lines(self, lines):
+        self.lines = lines
+        self.name = ""
+        self.fxs = []
+        self.fx_chain = None
+        self.fx_chain_end = None
+        self.added = []
+        self.removed = []
+
+        depth = 0
+        in_chain = False
+        starts = []
+        for i, line in enumerate(lines):
+            line = line.strip()
+            if line.startswith('<'):
+                depth += 1
+                if depth == 2 and line.split()[0] == '<FXCHAIN':
+                    in_chain = True
+                    self.fx_chain = i
+            elif line == '>':
+                depth -= 1
+                if depth == 1 and in_chain:
+                    self.fx_chain_end = i
+                    in_chain = False
+            elif depth == 1 and line.startswith('NAME '):
+                tokens = rpp_tokens(line)
+                self.name = tokens[1] if len(tokens) > 1 else ""
+            elif in_chain and depth == 2 and line.startswith('BYPASS '):
+                starts.append(i)
+
+        if starts:
+            for start, stop in zip(starts, starts[1:] + [self.fx_chain_end]):
+                self.fxs.append(ChunkFX(lines[start:stop], start, stop))
+
+    # Returns the `ChunkFX` of the given FX, found by GUID if possible.
+    def find(self, fx):
+        guid = getattr(fx, 'guid', None)
+        if guid:
+            for chunk_fx in self.fxs:
+                if chunk_fx.guid == guid:
+                    return chunk_fx
+            return None
+        return self.fxs[fx.index] if fx.index < len(self.fxs) else None
+
+    def set_name(self, chunk_fx, name):
+        i = chunk_fx.name_token()
+        while len(chunk_fx.tokens) <= i:
+            chunk_fx.tokens.append("")
+        chunk_fx.tokens[i] = name
+        chunk_fx.changed = True
+
+    def set_enabled(self, chunk_fx, enabled):
+        chunk_fx.enabled = enabled
+        chunk_fx.changed = True
+
+    # The plugin state of a VST, as bytes.
+    def get_state(self, chunk_fx):
+        if chunk_fx.state == None:
+            lines = chunk_fx.lines[chunk_fx.plugin + 2:chunk_fx.end - 1]
+            chunk_fx.state = b''.join(base64.b64decode(line.strip()) for line in lines)
+        return chunk_fx.state
+
+    def set_state(self, chunk_fx, state):
+        chunk_fx.state = state
+        chunk_fx.changed = True
+
+    # Add a copy of the given FX (which can be from another chunk) at the
+    # end of the FX chain. Returns the copy. The track should have an FX
+    # chain already.
+    def add(self, chunk_fx):
+        new_fx = chunk_fx.copy()
+        self.added.append(new_fx)
+        return new_fx
+
+    def remove(self, chunk_fx):
+        self.removed.append(chunk_fx)
+
+    # Write all edits to REAPER. Returns whether anything was written.
+    def commit(self):
+        replace = {}
+        for fx in self.fxs:
+            if fx in self.removed:
+                replace[fx.start] = (fx.stop, [])
+            elif fx.changed:
+                replace[fx.start] = (fx.stop, fx.render())
+
+        if not replace and not self.added:
+            return False
 
-    return name_start, name_end
+        lines = []
+        i = 0
+        while i < len(self.lines):
+            if i == self.fx_chain_end:
+                for fx in self.added:
+                    lines += fx.render()
 
+            if i in replace:
+                i, new_lines = replace[i]
+                lines += new_lines
+            else:
+                lines.append(self.lines[i])
+                i += 1
 
-# Changes the state chunk of the track to update the FX name.
-@rp.inside_reaper()
-@rp.undo_block('Multi-Sampler: set name')
-def set_fx_name(fx, new_name):
-    track = fx.parent
-    chunk = rp.reascript_api.GetTrackStateChunk(track.id, '', 2**25, False)[2]
+        self.set_lines(lines)
+        rp.reascript_api.SetTrackStateChunk(self.track_id, '\n'.join(lines), False)
+        return True
 
-    loc = find_fx_in_chunk(chunk, fx)
+# Parse the FX chain in the state chunk of a track. Returns a list with the
+# tuple (name, enabled, guid, plugin) for every FX on the track, in order.
+# The name is the one REAPER shows, so the custom name if the FX was
+# renamed. The plugin is the file name for VSTs, and otherwise the name of
+# the plugin.
+def parse_fx_chain(chunk):
+    if not isinstance(chunk, TrackChunk):
+        chunk = TrackChunk(None, chunk)
+    return [(fx.name(), fx.enabled, fx.guid, fx.plugin_file()) for fx in chunk.fxs]
+
+
+# # # ReaSamplOmatic5000 state # # #
+
+def rs5k_param(index):
+    return property(lambda self: self.params[index],
+                    lambda self, value: self.params.__setitem__(index, value))
+
+def rs5k_setting(offset, fmt):
+    return property(lambda self: struct.unpack_from(fmt, self.settings, offset)[0],
+                    lambda self, value: struct.pack_into(fmt, self.settings, offset, value))
+
+# The plugin state of ReaSamplOmatic5000, as stored in the track state chunk.
+# It starts with the (first) sample file, followed by the parameters as
+# normalized doubles, in the same order as in REAPER. Then come some more
+# settings, such as the mode. Settings of which the meaning is not known
+# are kept as they are. Without data, the state of a new instance is made.
+class RS5kState():
+    param_count = 16
+    default_params = (1.0, 0.5, 1.0, 0.0, 1.0, 0.06875, 0.86875, 0.0,
+                      4/9, 0.0005, 0.0005, 0.0, 0.0, 0.0, 1.0, 0.5)
+    default_settings = struct.pack('<iddididdddd5x', 1, 0.0, 1.0, 64, 1/6,
+                                   -1, 1/127, 1.0, 1.0, 0.0, 0.0)
+
+    mode_sample = 1 # `Sample (Ignores MIDI note)`
+    mode_note = 2   # `Note (Semitone shifted)`
+
+    def __init__(self, data=None):
+        if data == None:
+            self.filename = ""
+            self.params = list(self.default_params)
+            self.settings = bytearray(self.default_settings)
+            return
 
-    # Find the name.
-    loc = chunk.find("\n", loc + 1)
-    name_start, name_end = find_fx_name(chunk, loc)
+        end = data.index(b'\0')
+        self.filename = data[:end].decode(errors='surrogateescape')
+        self.params = list(struct.unpack_from(f'<{self.param_count}d', data, end + 1))
+        self.settings = bytearray(data[end + 1 + 8 * self.param_count:])
+
+    def encode(self):
+        return self.filename.encode(errors='surrogateescape') + b'\0' + \
+               struct.pack(f'<{self.param_count}d', *self.params) + bytes(self.settings)
+
+    # Parameters.
+    volume = rs5k_param(0)
+    pan = rs5k_param(1)
+    gain_min_velocity = rs5k_param(param_gain_min_velocity)
+    note_start = rs5k_param(param_note_start)
+    note_end = rs5k_param(param_note_end)
+    pitch_start = rs5k_param(param_pitch_start)
+    pitch_end = rs5k_param(6)
+    max_voices = rs5k_param(8)
+    attack = rs5k_param(9)
+    release = rs5k_param(10)
+    obey_note_offs = rs5k_param(param_obey_note_offs)
+    loop = rs5k_param(12)
+    sample_start = rs5k_param(13)
+    sample_end = rs5k_param(14)
+    pitch_adjust = rs5k_param(15)
+
+    # Settings.
+    mode = rs5k_setting(0, '<i')
+    pitchbend_range = rs5k_setting(24, '<d')
+    min_velocity = rs5k_setting(36, '<d')
+    max_velocity = rs5k_setting(44, '<d')
+    probability = rs5k_setting(52, '<d')
+    round_robin = rs5k_setting(60, '<d')
 
-    # Enter the name in the chunk.
-    if " " in new_name:
-        new_name = f'"{new_name}"'
-    chunk_new = chunk[:name_start] + new_name + chunk[name_end:]
 
-    # Update the chunk.
-    rp.reascript_api.SetTrackStateChunk(track.id, chunk_new, False)
+# # # Setup functions # # #
 
-@rp.inside_reaper()
+# Add ReaSamplOmatic5000 instances in REAPER, given the tuple
+# (note start, note end, name, filenames) for every instance. The list of
+# filenames can be empty. All instances are created in the state chunk of
+# the track, so this costs just a few calls, no matter the amount.
+# Runs on the REAPER worker. Returns the new FX and the color of the track.
 @rp.undo_block('Multi-Sampler: add ReaSamplOmatic5000')
-def add_in_reaper(samplorange, track, note_start, note_end,
-            gain_for_minimum_velocity, create_pitched):
-    samplomatic = track.add_fx("ReaSamplOmatic5000")
-
-    if create_pitched:
-        set_fx_mode(samplomatic)
+def add_in_reaper(track, instances, gain_for_minimum_velocity,
+                  create_pitched, disable):
+    # The template is an instance added with the API, such that it has the
+    # current default preset of the user. This also creates the FX chain if
+    # there is none. The template itself is removed again.
+    fx = track.add_fx("ReaSamplOmatic5000")
+    chunk = TrackChunk(track.id)
+    template = chunk.fxs[fx.index]
+    chunk.remove(template)
+    template_state = chunk.get_state(template)
+
+    for note_start, note_end, name, filenames in instances:
+        state = RS5kState(template_state)
+        state.filename = filenames[0] if filenames else ""
+        state.gain_min_velocity = gain_for_minimum_velocity
+        state.note_start = note_start / 127
+        state.note_end = note_end / 127
+        state.obey_note_offs = float(create_pitched)
+        if create_pitched:
+            state.mode = RS5kState.mode_note
+
+        chunk_fx = chunk.add(template)
+        chunk.set_state(chunk_fx, state.encode())
+        chunk.set_name(chunk_fx, name)
+        chunk.set_enabled(chunk_fx, not disable)
+
+    guids = [fx.guid for fx in chunk.added]
+    chunk.commit()
+
+    # The track chunk now has all FX, so the cache can be updated with it.
+    fx_cache.update(track.id, chunk)
+    fxs = [FXHandle(track.id, fx_cache.tracks[track.id].index(guid), guid)
+           for guid in guids]
+
+    # The state only holds the first sample, the others are set separately.
+    for fx, (_, _, _, filenames) in zip(fxs, instances):
+        if len(filenames) > 1:
+            set_samples(fx, filenames)
+
+    # Detect the pitch of every new instance, for which its UI has to be
+    # open. Otherwise only open the last one.
+    if create_pitched and detect_pitch_script_id:
+        project = rp.Project()
+        for fx in fxs:
+            fx.open_ui()
+            project.perform_action(detect_pitch_script_id)
+    elif fxs:
+        fxs[-1].open_ui()
 
-    if samplorange:
-        samplorange.fx = samplomatic
-        samplorange.index = samplomatic.index
+    return fxs, track.color
 
-        samplorange.track_routing = current_track_routing
-        samplorange.track_routing.samplorange_count += 1
+def set_samples(fx, filenames):
+    for i, filename in enumerate(filenames):
+        rp.reascript_api.TrackFX_SetNamedConfigParm(fx.parent_id,
+                fx.index, f"FILE{i}", filename)
 
-    params = samplomatic.params
-    params["Obey note-offs"] = create_pitched
-    params["Gain for minimum velocity"] = gain_for_minimum_velocity
-    params["Note range start"] = note_start / 127
-    params["Note range end"] = note_end / 127
+# Add ReaSamplOmatic5000 instances to the track. For every instance, the
+# tuple (sample range, note start, note end, filenames) is given, in which
+# the sample range is None if the track is not the current one.
+def add_instances(track, instances):
+    global samploranges, name_by_general_midi
 
-    global name_by_general_mid
-    if name_by_general_midi.get():
-        if samplorange.start in general_midi_drumkit:
-            name = general_midi_drumkit[samplorange.start]
+    names = []
+    for samplorange, note_start, note_end, _ in instances:
+        if name_by_general_midi.get():
+            if note_start in general_midi_drumkit:
+                name = general_midi_drumkit[note_start]
+            else:
+                name = default_fx_name
+            if name_by_general_midi_nocaps:
+                name = name.lower()
+        elif samplorange and samplorange.current_name:
+            name = samplorange.current_name
         else:
             name = default_fx_name
-        if name_by_general_midi_nocaps:
-            name = name.lower()
-        set_fx_name(samplomatic, name)
-    elif samplorange and samplorange.current_name:
-        set_fx_name(samplomatic, samplorange.current_name)
-    else:
-        set_fx_name(samplomatic, default_fx_name)
+        names.append(name)
 
-    global samploranges
     soloing = any(s.solo for s in samploranges)
-    if soloing:
-        samplomatic.disable()
+    reaper_call(add_in_reaper, track,
+                [(start, end, name, filenames) for (_, start, end, filenames), name
+                 in zip(instances, names)],
+                gain_for_minimum_velocity, create_pitched.get(), soloing,
+                callback=lambda result: add_done(instances, names, result))
+
+# Link the sample ranges to the newly added FX.
+def add_done(instances, names, result):
+    global samploranges, current_track_routing
+    if isinstance(result, ReaperError):
+        parse_current()
+        return
+    fxs, color = result
+
+    for (samplorange, note_start, note_end, _), name, fx in zip(instances, names, fxs):
+        # The sample range might have been removed in the meantime.
+        if not samplorange or not samplorange in samploranges:
+            continue
+
+        samplorange.fx = fx
+        samplorange.fx_name = name
 
-    samplomatic.open_ui()
+        samplorange.track_routing = current_track_routing
+        samplorange.track_routing.samplorange_count += 1
 
-    if create_pitched:
-        if detect_pitch_script_id:
-            rp.Project().perform_action(detect_pitch_script_id)
+        if color != (0, 0, 0) and samplorange.color != color:
+            samplorange.color = color
+            samplorange.redraw()
+
+        # It might have been moved while it was being added.
+        if samplorange.start != note_start or samplorange.end != note_end:
+            samplorange.update_reaper()
 
 
 # Add new ReaSamplOmatic5000 instance.
-def setup(track, note_start = -1, note_end = -1):
+def setup(track, note_start = -1, note_end = -1, color=(0, 0, 0)):
     global root, current_track, samploranges, window, last_touched
 
     # The default note ranges.
@@ -1052,7 +2133,7 @@ def setup(track, note_start = -1, note_end = -1):
 
     # Add the widget in the GUI
     if track == current_track:
-        samplorange = SamploRange(window, None, track.color, note_start, note_end)
+        samplorange = SamploRange(window, None, color, note_start, note_end)
         samploranges.append(samplorange)
         last_touched = samplorange
 
@@ -1062,162 +2143,190 @@ def setup(track, note_start = -1, note_end = -1):
         samplorange = None
 
     # Add the instance in REAPER.
-    root.after(50, add_in_reaper, samplorange, track, note_start, note_end,
-               gain_for_minimum_velocity, create_pitched.get())
+    add_instances(track, [(samplorange, note_start, note_end, [])])
+
+
+# Returns the tracks to add instances to, with their colors. If no track is
+# selected, create a new one. Runs on the REAPER worker.
+def init_tracks(frozen, track):
+    project = rp.Project()
+
+    tracks = project.selected_tracks if not frozen else [track]
+    created = False
+    if len(tracks) == 0:
+        tracks = [project.add_track()]
+        tracks[0].name = default_multisampler_name
+        tracks[0].select()
+        created = True
 
+    return [(track, track.color) for track in tracks], created
 
 # If no track is selected, create a new one. Then add new ReaSamplOmatic5000
 # instances to all selected tracks.
 def init(insert_at_cursor=False):
-    global current_track, track_name_text, root
+    global current_track, root
 
-    with rp.inside_reaper():
-        project = rp.Project()
+    note = -1
+    if insert_at_cursor:
+        scroll_pos = canvas.xview()[0] * 128
+        cursor_x = root.winfo_pointerx() - root.winfo_rootx()
+        note = int(scroll_pos + cursor_x // width_per_note)
 
-        # Set all selected tracks. If none are selected, create a new one.
-        tracks = project.selected_tracks if not freeze.get() else [current_track]
-        if len(tracks) == 0:
-            tracks = [project.add_track()]
-            tracks[0].name = default_multisampler_name
-            track_name_text.set(default_multisampler_name)
-            tracks[0].select()
-            current_track = tracks[0]
-            parse_current()
+    reaper_call(init_tracks, freeze.get(), current_track,
+                callback=lambda result: init_done(result, note))
 
+def init_done(result, note):
+    global current_track, current_track_routing, track_name_text, parse_generation
+    if isinstance(result, ReaperError):
+        parse_current()
+        return
+    tracks, created = result
 
-    for track in tracks:
-        if not insert_at_cursor:
-            setup(track)
-        else:
-            scroll_pos = canvas.xview()[0] * 128
-            cursor_x = root.winfo_pointerx() - root.winfo_rootx()
-            note = int(scroll_pos + cursor_x // width_per_note)
-            setup(track, note, note)
+    # The new track is empty, so there is no need to parse it.
+    if created:
+        current_track = tracks[0][0]
+        track_name_text.set(default_multisampler_name)
+        parse_generation += 1
+        clear_samploranges()
+        current_track_routing = Route()
 
+    for track, color in tracks:
+        setup(track, note, note, color)
 
-def refresh():
-    global current_track
+
+# Reconnect, and return the selected track. Runs on the REAPER worker.
+def refresh_in_reaper():
     rp.reconnect()
-    project = rp.Project()
-    tracks = project.selected_tracks
-    if len(tracks) > 0:
-        current_track = tracks[0]
+    with rp.inside_reaper():
+        tracks = rp.Project().selected_tracks
+        return tracks[0] if len(tracks) > 0 else None
+
+def refresh():
+    reaper_call(refresh_in_reaper, callback=refresh_done, hold=False)
+
+def refresh_done(track):
+    global current_track, parse_generation
+    if isinstance(track, ReaperError):
+        return
+    if track:
+        current_track = track
         parse_current()
     else:
+        parse_generation += 1
         clear_samploranges()
 
 
-
 def detect_pitch_selected():
     global samploranges
     if not detect_pitch_script_id:
         return
 
     delay = 1000
-    for i, samplorange in enumerate(samploranges):
-        if samplorange.selected:
-            root.after(100 + i * delay, detect_pitch, samplorange)
+    for i, samplorange in enumerate([s for s in selection if s.fx]):
+        root.after(100 + i * delay, reaper_call, detect_pitch, samplorange.fx)
 
-@rp.inside_reaper()
-def detect_pitch(samplorange):
+# Runs on the REAPER worker.
+def detect_pitch(fx):
+    fx = resolve_fx(fx)
+    if not fx:
+        return
     project = rp.Project()
-    samplorange.fx.open_ui()
+    fx.open_ui()
     project.perform_action(detect_pitch_script_id)
 
 
 # # # Separate functionality # # #
 
-# Helper function for below.
-def separate_track(track, bus):
-    global samploranges, create_bus_on_separate, separate_overlap
+# Helper function for below. The tuple (fx, group, name) is given in
+# `instances` for every instance to separate. Instances in the same group
+# overlap, and are put on the same track if `separate_overlap` is not set.
+def separate_track(track, bus, instances, create_bus, overlap):
     project = rp.Project()
 
     track_groups = {}
     track_index = track.index
 
-    samploranges_selected = [s for s in samploranges if s.selected]
-    if len(samploranges_selected) > 0:
-        samploranges_separate = samploranges_selected
-    else:
-        samploranges_separate = samploranges
+    instances = [(resolve_fx(fx), group, name) for fx, group, name in instances]
+    instances = [x for x in instances if x[0]]
+    instances.sort(key=lambda x: -x[0].index)
 
-    samploranges_separate.sort(key=lambda x: -x.fx.index)
-
-    for srange in samploranges_separate:
+    for fx, group, name in instances:
             index_add = 1 if not bus else 2
 
-            if not separate_overlap.get():
-                if not srange.render_group in track_groups:
-                    track_groups[srange.render_group] = project.add_track(
-                            index=track_index+index_add, name=f"{srange.fx.name}")
-                    send = track.add_send(track_groups[srange.render_group])
-                track_new = track_groups[srange.render_group]
+            if not overlap:
+                if not group in track_groups:
+                    track_groups[group] = project.add_track(
+                            index=track_index+index_add, name=f"{name}")
+                    send = track.add_send(track_groups[group])
+                track_new = track_groups[group]
             else:
                 track_new = project.add_track(index=track_index+index_add,
-                                              name=f"{srange.fx.name}")
+                                              name=f"{name}")
                 send = track.add_send(track_new)
 
-            if create_bus_on_separate.get():
+            if create_bus:
                 # Select the track.
                 track_new.select()
 
             # Move the fx to the tracks.
-            srange.fx.move_to_track(track_new)
+            fx.move_to_track(track_new)
+            fx_cache.remove(track.id, fx.guid)
 
 
 # Split the ReaSamplOmatic5000 instances over separate tracks.
 # If 'create bus' is ticked, put them in a folder too.
 def separate():
-    global root, current_track
+    global current_track, samploranges, create_bus_on_separate, separate_overlap
     if not current_track:
         return
 
+    samploranges_selected = list(selection)
+    if len(samploranges_selected) > 0:
+        samploranges_separate = samploranges_selected
+    else:
+        samploranges_separate = samploranges
+
+    groups = {}
+    instances = [(s.fx, groups.setdefault(s.render_group, len(groups)), s.fx_name)
+                 for s in samploranges_separate if s.fx]
+
     track_name_text.set("   separating...   ")
-    root.after(100, separate_samploranges)
+    reaper_call(separate_samploranges, current_track, instances,
+                create_bus_on_separate.get(), separate_overlap.get(),
+                callback=lambda result: parse_current())
 
-@rp.inside_reaper()
+# Runs on the REAPER worker.
 @rp.undo_block('Multi-Sampler: separate')
-def separate_samploranges():
-    global current_track, create_bus_on_separate
+def separate_samploranges(track, instances, create_bus, overlap):
     project = rp.Project()
 
     bus = None
-    if create_bus_on_separate.get():
+    if create_bus:
         # Clear the selection for folder creation.
         project.unselect_all_tracks()
 
         # Add a bus track.
-        bus = project.add_track(index=current_track.index+1,
-                                name=f"bus - {current_track.name}")
+        bus = project.add_track(index=track.index+1,
+                                name=f"bus - {track.name}")
         bus.select()
 
     # Create the tracks for all ReaSamplOmatic5000s.
-    separate_track(current_track, bus)
+    separate_track(track, bus, instances, create_bus, overlap)
 
     # Create the folder.
-    if create_bus_on_separate.get():
+    if create_bus:
         try:
             project.perform_action(rp.reascript_api.NamedCommandLookup("_SWS_MAKEFOLDER"))
 
             # Go back to selecting the original track.
             project.unselect_all_tracks()
-            current_track.select()
+            track.select()
         except:
             print("Install the SWS extension for automatic folder creation")
 
-    parse_current()
-
 
 # # # Drag and drop # # #
 
-@rp.inside_reaper()
-def set_samples(fx, filenames):
-    track = fx.parent
-
-    for i, filename in enumerate(filenames):
-        rp.reascript_api.TrackFX_SetNamedConfigParm(track.id,
-                fx.index, f"FILE{i}", filename)
-
 mouse_pos = [-1, -1]
 samploranges_drag = None
 def set_mouse_pos(event):
@@ -1245,7 +2354,7 @@ def drop_enter(event):
 
     if not event.data:
         samploranges_drag = None
-        rp.reaper.show_message_box(
+        reaper_call(rp.reaper.show_message_box,
                 "No data in drag and drop event.\n\n" \
                 "Consider enabling drag and drop from REAPER \n (Check `D\&D REAPER`)",
                 "Multi Sampler error: drag and drop")
@@ -1300,9 +2409,7 @@ def drop_leave(event):
     for srange in samploranges_drag:
         delete_in_render_groups(srange)
 
-        srange.widget.destroy()
-        if srange.tooltip:
-            srange.tooltip.destroy()
+        srange.destroy()
         samploranges.remove(srange)
 
     samploranges_drag = None
@@ -1328,14 +2435,8 @@ def dnd_remove_warning():
 def drop_reaper():
     global samploranges_drag, current_track
 
-    for srange in samploranges_drag:
-        with rp.inside_reaper():
-            srange.color = current_track.color
-            add_in_reaper(srange, current_track, srange.start,
-                        srange.end, gain_for_minimum_velocity,
-                        create_pitched.get())
-            set_samples(srange.fx, [srange.filename])
-        srange.redraw()
+    add_instances(current_track, [(srange, srange.start, srange.end, [srange.filename])
+                                  for srange in samploranges_drag])
     samploranges_drag = None
 
 
@@ -1344,148 +2445,330 @@ def drop_reaper():
 
 # # # Track parsing # # #
 
-# Return true if the given fx is a ReaSamplOmatic instance.
-@rp.inside_reaper()
-def is_samplomatic(fx):
-    try:
-        fx.params["Note range start"]
-        return True
-    except Exception as e:
-        return False
-    # fx_name = rp.reascript_api.TrackFX_GetNamedConfigParm(
-    #         fx.parent.id, fx.index, 'fx_name', '', 100000)[4]
-    # return "ReaSamplOmatic5000" in fx_name
+# Return true if the plugin found by `parse_fx_chain` is ReaSamplOmatic5000,
+# for instance `reasamplomatic.dll` or `reasamplomatic.vst.dylib`.
+def is_samplomatic_plugin(plugin):
+    return plugin.lower().startswith("reasamplomatic")
 
 
 class Route(dict):
     samplorange_count = 0
 
-# Recursively parse all ReaSamplOmatic5000 on the given track
-# and all of its recursive MIDI sends.
-def parse(track, no_reset=False, track_routing=None, recursion_depth=max_recursion_depth):
-    global window, samploranges, render_groups, current_track_routing
-
-    if recursion_depth == max_recursion_depth:
-        print("Start parsing track...")
-
-        # Remove the previous track info.
-        if not no_reset:
-            clear_samploranges()
-
-        # Setup the routing dictionary.
-        track_routing = Route()
-    elif recursion_depth == 0:
+# Returns the tuple (destination track id, sends MIDI) for every send of
+# the track. Sends are stored on the receiving track in the state chunk, so
+# these are asked from REAPER. Runs on the REAPER worker.
+def get_sends(track_id):
+    api = rp.reascript_api
+    sends = []
+    for i in range(api.GetTrackNumSends(track_id, 0)):
+        pointer = api.GetTrackSendInfo_Value(track_id, 0, i, 'P_DESTTRACK')
+        flags = api.GetTrackSendInfo_Value(track_id, 0, i, 'I_MIDIFLAGS')
+        dest_id = '(MediaTrack*)0x{0:016X}'.format(int(pointer))
+        sends.append((dest_id, int(flags) != midi_flags_no_midi))
+    return sends
+
+# Convert a native color to RGB. Which byte is red depends on the system,
+# which is asked from REAPER only once.
+native_red_first = None
+def rgb_from_native(native):
+    global native_red_first
+    if native_red_first == None:
+        _, r, _, _ = rp.reascript_api.ColorFromNative(0x030201, 0, 0, 0)
+        native_red_first = r == 1
+    native = int(native)
+    r, g, b = native & 0xff, (native >> 8) & 0xff, (native >> 16) & 0xff
+    return (r, g, b) if native_red_first else (b, g, r)
+
+def get_track_color(track_id):
+    return rgb_from_native(rp.reascript_api.GetTrackColor(track_id))
+
+# Recursively find all ReaSamplOmatic5000 on the given track and all of its
+# recursive MIDI sends. For every instance, the tuple
+# (fx, color, note start, note end, mute, name, routing) is added to
+# `instances`. Everything about the FX is read from the state chunk of the
+# track, which is fetched once, so only the sends and the color are asked
+# for separately. Runs on the REAPER worker.
+def parse(track_id, instances, track_routing, recursion_depth=max_recursion_depth, chunk=None):
+    if recursion_depth == 0:
         return
 
-    project = rp.Project()
-
     # Parse the send tracks recursively.
-    for send in list(track.sends):
-        dest_track = send.dest_track
-        track_routing[dest_track.id] = Route()
-        if not send.midi_dest == (-1, -1):
-            parse(dest_track, no_reset, track_routing[dest_track.id], recursion_depth - 1)
-
-    # Create Range elements for all Samplomatics on the track.
-    fxs = track.fxs
-    for fx in list(fxs):
-        if is_samplomatic(fx):
-            if not no_reset:
-                srange = SamploRange(window, fx, track.color)
-                samploranges.append(srange)
-
-                # Add to the render groups.
-                move_through_groups(render_groups, srange)
-
-                # Routing info
-                srange.track_routing = track_routing
-                srange.track_routing.samplorange_count += 1
-
-    if recursion_depth == max_recursion_depth:
-        current_track_routing = track_routing
-        print("Done!")
-
-# Simple in-between function to make sure all parsing happens
-# inside REAPER via reapy (which is a lot faster).
-@rp.inside_reaper()
-def parse_reaper(track, no_reset=False):
-    global track_name_text
-    parse(track, no_reset)
-    track_name_text.set(track.name)
-
-# Call the recursive `parse` on the currently selected track.
-# Set `no_reset` to True to not reset all samploranges, but to
-# simply update them if any changed might be present.
-def parse_current(no_reset=False):
-    global root, current_track, track_name_text
+    for dest_id, midi in get_sends(track_id):
+        track_routing[dest_id] = Route()
+        if midi:
+            parse(dest_id, instances, track_routing[dest_id], recursion_depth - 1)
+
+    # Read the note ranges of all Samplomatics on the track.
+    if chunk == None:
+        chunk = TrackChunk(track_id)
+    fx_cache.update(track_id, chunk)
+    color = get_track_color(track_id)
+    for index, chunk_fx in enumerate(chunk.fxs):
+        if fx_cache.samplomatic[chunk_fx.guid]:
+            state = RS5kState(chunk.get_state(chunk_fx))
+            instances.append((FXHandle(track_id, index, chunk_fx.guid), color,
+                              round(state.note_start * 127),
+                              round(state.note_end * 127),
+                              not chunk_fx.enabled, chunk_fx.name(), track_routing))
+            track_routing.samplorange_count += 1
+
+# Parse the given track. Returns the track name, the routing and the
+# instances found by `parse`. Runs on the REAPER worker.
+def parse_reaper(track):
+    print("Start parsing track...")
+    track_routing = Route()
+    instances = []
+    chunk = TrackChunk(track.id)
+    parse(track.id, instances, track_routing, chunk=chunk)
+    print("Done!")
+
+    # REAPER shows a default name for tracks without one.
+    return chunk.name or track.name, track_routing, instances
+
+# Call the recursive `parse` on the currently selected track. Only the
+# result of the most recent parse is used.
+parse_generation = 0
+def parse_current():
+    global root, current_track, track_name_text, parse_generation
+    parse_generation += 1
     if current_track:
-        parse_reaper(current_track, no_reset)
+        reaper_call(parse_reaper, current_track,
+                    callback=lambda result, g=parse_generation: parse_done(result, g))
     else:
         track_name_text.set("")
 
+# Create the sample ranges from the result of `parse_reaper`.
+def parse_done(result, generation):
+    global window, samploranges, render_groups, current_track_routing, \
+           track_name_text, parse_generation
+    if generation != parse_generation or isinstance(result, ReaperError):
+        return
+
+    name, track_routing, instances = result
+
+    # Remove the previous track info.
+    clear_samploranges()
+
+    for fx, color, start, end, mute, fx_name, route in instances:
+        srange = SamploRange(window, fx, color, start, end,
+                             mute=mute, fx_name=fx_name)
+        samploranges.append(srange)
+
+        # Add to the render groups.
+        move_through_groups(render_groups, srange)
+
+        # Routing info
+        srange.track_routing = route
+
+    current_track_routing = track_routing
+    track_name_text.set(name)
+    startup_phase("first parse")
+
+
+# # # Sync scheduling # # #
+
+# Schedules the loop which checks REAPER for changes. While nothing changes,
+# the interval grows by `backoff` every check, up to `interval_max`. After
+# a change or any user interaction, it snaps back to `interval_min`.
+# The `hits` and `misses` count the checks that did and didn't find changes.
+class SyncScheduler():
+    def __init__(self, callback, interval_min, interval_max, backoff):
+        self.callback = callback
+        self.interval_min = interval_min
+        self.interval_max = interval_max
+        self.backoff = backoff
+
+        self.interval = interval_min
+        self.job = None
+        self.hits = 0
+        self.misses = 0
+
+    def hit(self):
+        self.hits += 1
+        self.interval = self.interval_min
+
+    def miss(self):
+        self.misses += 1
+        self.interval = min(self.interval_max, self.interval * self.backoff)
+
+    # Go back to fast polling, and check soon if we are waiting.
+    def burst(self):
+        global root
+        if self.interval == self.interval_min:
+            return
+
+        self.interval = self.interval_min
+        if self.job:
+            root.after_cancel(self.job)
+            self.schedule()
+
+    def schedule(self):
+        global root
+        self.job = root.after(int(self.interval), self.run)
+
+    def run(self):
+        self.job = None
+        self.callback()
+
 
 # Check if the selection has changed, and loop.
-slow_counter = 0
-slow_counter_max = 10
+sync_scheduler = None
+was_focused = True
 def sync():
-    global root, current_track, freeze, slow_counter, samploranges, samploranges_drag
-    into_focus = False
+    global root, current_track, freeze, was_focused, samploranges, samploranges_drag
+
+    # While the window is hidden, only check that REAPER is still there.
+    # See `hide_window`.
+    if root.state() == "withdrawn":
+        sync_scheduler.interval = sync_scheduler.interval_max
+        reaper_call(get_change_count, callback=ping_done)
+        return
 
     if stay_on_top.get() != root.attributes('-topmost'):
         root.attributes('-topmost', stay_on_top.get())
 
+    into_focus = run_sync = False
     if sync_with_reaper.get() and samploranges_drag == None:
-        # Run the slow reaper check when the window comes into focus.
-        if root.focus_displayof() != None and slow_counter > 0:
-            reaper_sync_slow()
-            slow_counter = 0
-            into_focus = True
+        focused = root.focus_displayof() != None
 
-        # If not focused, up the counter.
-        if root.focus_displayof() == None:
-            slow_counter += 1
+        # Run the slow reaper check when the window comes into focus.
+        into_focus = focused and not was_focused
+        was_focused = focused
 
         # Run the quicker REAPER check depending on whether dnd is enabled.
         if allow_reaper_drag_and_drop.get():
             # Run the external REAPER checks only when the window come into focus.
-            if into_focus:
-                reaper_sync()
+            run_sync = into_focus
         else:
             # Run the external REAPER checks only when the window is not focused.
-            if root.focus_displayof() == None:
-                reaper_sync()
+            run_sync = not focused
 
     # Necessary on some systems to close the popup menu.
     if root.focus_displayof() == None:
         popup_close()
 
-    check_loop = root.after(100, sync)
+    # The next check is scheduled once REAPER has answered.
+    if into_focus or run_sync:
+        sync_now(into_focus, run_sync)
+    else:
+        sync_scheduler.schedule()
+
+# Stop when REAPER is gone, such that the next launch starts anew.
+def ping_done(result):
+    if isinstance(result, ReaperError):
+        print("Lost the connection to REAPER, quitting.")
+        close()
+    else:
+        sync_scheduler.schedule()
+
+# Check REAPER for changes on the REAPER worker. When `force` is set, the
+# checks are done even if REAPER reports no changes. Set `reschedule` to
+# schedule the next sync when done.
+def sync_now(slow=True, fast=True, force=False, reschedule=True):
+    global current_track, current_track_routing, samploranges, freeze
+    track_ids = {srange.fx.parent_id for srange in samploranges if srange.fx}
+    reaper_call(reaper_poll, slow, fast, current_track, current_track_routing,
+                freeze.get(), track_ids, force,
+                callback=lambda result: poll_done(result, reschedule))
+
+# Both checks are skipped when nothing changed in REAPER, which costs only
+# a single request. Runs on the REAPER worker. Returns the tuple
+# (checked, reparse, track_change, snapshot), see below.
+# Errors are caught here, so that the sync loop keeps running.
+def reaper_poll(slow, fast, track, routing, frozen, track_ids, force=False):
+    checked, reparse = False, False
+    track_change, snapshot = None, None
+
+    try:
+        change_count = None if force else get_change_count()
+
+        if slow:
+            checked, reparse = reaper_sync_slow(track, routing, change_count)
+
+        if fast:
+            checked_fast, track_change, snapshot = reaper_sync(track, frozen, track_ids,
+                                                               change_count)
+            checked |= checked_fast
+    except Exception:
+        import traceback
+        traceback.print_exc()
+
+    return checked, reparse, track_change, snapshot
+
+# Apply the result of `reaper_poll`. If REAPER could not be reached, try
+# again later.
+def poll_done(result, reschedule):
+    global current_track, last_touched, parse_generation, track_name_text
+    if isinstance(result, ReaperError):
+        result = (False, False, None, None)
+    checked, reparse, track_change, snapshot = result
+
+    if track_change:
+        current_track, name = track_change
+        track_name_text.set(name)
+
+        if current_track:
+            parse_current()
+        else:
+            last_touched = None
+
+            # Remove the previous track info.
+            parse_generation += 1
+            clear_samploranges()
+    elif reparse:
+        parse_current()
+    elif snapshot != None:
+        apply_snapshot(snapshot)
+
+    if checked:
+        sync_scheduler.hit()
+    else:
+        sync_scheduler.miss()
+
+    if reschedule:
+        sync_scheduler.schedule()
+
+
+# REAPER increases the project state change count on every change to the
+# project, including selection changes. Reading it is a single small
+# request, so it is used to skip all other checks when nothing changed.
+def get_change_count():
+    return rp.reascript_api.GetProjectStateChangeCount(0)
 
 
 # Recusively checks if the routing is still correct and if all tracks
 # still have the same mount of ReaSamplOmatic5000 instances.
-def no_routing_or_fx_change(track, routing):
-    midi_sends = [send for send in track.sends if not send.midi_dest == (-1, -1)]
+routing_chunk_hashes = {}
+def no_routing_or_fx_change(track_id, routing):
+    global routing_chunk_hashes
+    midi_sends = [dest_id for dest_id, midi in get_sends(track_id) if midi]
 
     # Amount of routes should be the same.
     if len(routing) != len(midi_sends):
         return False
 
-    # Amount of ReaSamplOmatic5000 instances should be the same
-    samplorange_count = len([fx for fx in track.fxs if is_samplomatic(fx)])
-    if samplorange_count != routing.samplorange_count:
-        return False
+    # Amount of ReaSamplOmatic5000 instances should be the same. This only
+    # needs to be checked if the state chunk of the track changed since
+    # the last time it was checked.
+    chunk = get_track_chunk(track_id)
+    chunk_hash = hash(chunk)
+    if routing_chunk_hashes.get(track_id) != chunk_hash:
+        fx_cache.update(track_id, chunk)
+        samplorange_count = len([guid for guid in fx_cache.tracks[track_id]
+                                 if fx_cache.samplomatic[guid]])
+        if samplorange_count != routing.samplorange_count:
+            return False
+        routing_chunk_hashes[track_id] = chunk_hash
 
     # Recursively check the sends.
-    for send in midi_sends:
-        track_id = send.dest_track.id
+    for dest_id in midi_sends:
 
         # It should have the same tracks.
-        if not track_id in routing:
+        if not dest_id in routing:
             return False
 
         # Continue recursively.
-        if not no_routing_or_fx_change(send.dest_track, routing[track_id]):
+        if not no_routing_or_fx_change(dest_id, routing[dest_id]):
             return False
 
     return True
@@ -1496,106 +2779,158 @@ def clear_samploranges():
     global samploranges, render_groups
 
     for srange in samploranges:
-        srange.widget.destroy()
-        if srange.tooltip:
-            srange.tooltip.destroy()
+        srange.destroy()
 
     samploranges = []
     render_groups = []
 
+    global grabbed_range
+    grabbed_range = None
+
+    # Make sure the new note ranges are checked on the next sync.
+    global snapshot_previous
+    snapshot_previous = {}
+
+
+# # # Snapshots # # #
+
+# The state of a single track, as far as `reaper_sync` is concerned: the
+# track color, and the (name, enabled) tuple of every FX on the track,
+# by GUID.
+# The hash of the state chunk is kept to compare snapshots quickly.
+class TrackSnapshot():
+    def __init__(self, color, chunk_hash, fxs):
+        self.color = color
+        self.chunk_hash = chunk_hash
+        self.fxs = fxs
+
+    def __eq__(self, other):
+        return isinstance(other, TrackSnapshot) and \
+               self.color == other.color and self.chunk_hash == other.chunk_hash
+
+# Take a snapshot of the given tracks. Everything about the FX is read from
+# the track state chunk, so this costs two calls per track, instead of
+# a couple per FX. The chunk is only parsed if it changed.
+# Runs on the REAPER worker, which keeps its own snapshot cache.
+snapshot_cache = {}
+def take_snapshot(track_ids):
+    global snapshot_cache
+    snapshot = {}
+    for track_id in track_ids:
+        color = get_track_color(track_id)
+        chunk = get_track_chunk(track_id)
+        chunk_hash = hash(chunk)
+
+        previous = snapshot_cache.get(track_id)
+        if previous and previous.chunk_hash == chunk_hash:
+            fxs = previous.fxs
+        else:
+            fx_chain = parse_fx_chain(chunk)
+            fxs = {guid: (name, enabled) for name, enabled, guid, _ in fx_chain}
 
-@rp.inside_reaper()
-def reaper_sync():
-    global current_track, samploranges, track_name_text
-
-    project = rp.Project()
-    tracks = project.selected_tracks
-    n_tracks = len(tracks)
-
-    # Check for track changes if not frozen.
-    if not freeze.get():
-        # Only show track info is precisely one is selected.
-        if n_tracks != 1:
-            current_track = None
-            track_name_text.set("")
-            last_touched = None
-
-            # Remove the previous track info.
-            clear_samploranges()
-
-            return
+            # Keep the FX cache up to date for free.
+            fx_cache.set_chain(track_id, fx_chain)
 
-        # Check if the track has changed.
-        if current_track != tracks[0]:
-            current_track = tracks[0]
-            track_name_text.set(str(current_track.name).strip())
+        snapshot[track_id] = TrackSnapshot(color, chunk_hash, fxs)
 
-            parse_current()
-            return
+    snapshot_cache = snapshot
+    return snapshot
 
-    # Check for ReaSamplOmatic5000 changes
-    global alpha
+# Compare the snapshot to the previous one, and update the note ranges on
+# the tracks that changed.
+snapshot_previous = {}
+def apply_snapshot(snapshot):
+    global samploranges, snapshot_previous, alpha
     soloing = any(s.solo for s in samploranges)
+    changed = {track_id for track_id, track in snapshot.items()
+               if snapshot_previous.get(track_id) != track}
+    fx_states = []
+
     for srange in samploranges:
-        if srange.fx == None:
+        if srange.fx == None or not srange.fx.parent_id in changed:
+            continue
+
+        track = snapshot[srange.fx.parent_id]
+        if not srange.fx.guid in track.fxs:
             continue
 
         # Check for track color changes.
-        color = srange.fx.parent.color
+        color = track.color
         if color != (0, 0, 0) and srange.color != color:
             srange.color = color
-            srange.widget.configure(highlightbackground=rgb(color),
-                                    bg=rgb(color, alpha))
+            mark_dirty(srange, place=False)
 
         # Check for name changes.
-        if srange.current_name != srange.fx.name:
+        name, enabled = track.fxs[srange.fx.guid]
+        if srange.fx_name != name:
+            srange.fx_name = name
             srange.current_name = None
-            srange.draw_name()
+            mark_dirty(srange, color=False)
 
         # Check bypass changes.
-        if soloing:
-            if srange.solo and not srange.fx.is_enabled:
-                srange.fx.enable()
-            elif not srange.solo and srange.fx.is_enabled:
-                srange.fx.disable()
-        else:
-            if srange.fx.is_enabled == srange.mute:
-                srange.set_mute(srange.mute)
+        if enabled != srange.reaper_enabled(soloing):
+            fx_states.append((srange.fx, srange.reaper_enabled(soloing)))
 
+    if fx_states:
+        reaper_call(set_enabled_in_reaper, fx_states)
 
+    snapshot_previous = snapshot
 
-# Check for changes in REAPER which take a bit more time.
-# Only called when not interacting with the UI.
-@rp.inside_reaper()
-def reaper_sync_slow():
-    global current_track, current_track_routing, samploranges
 
-    if not current_track:
-        return
+# Check for changes in REAPER: track selection, and the color, name and
+# bypass state of the FX. When `change_count` is given, nothing is done if
+# it is the same as during the previous check. Runs on the REAPER worker.
+# Returns whether anything was checked, the new track and its name if the
+# selection changed, and otherwise a snapshot of the given tracks.
+sync_change_count = None
+def reaper_sync(track, frozen, track_ids, change_count=None):
+    global sync_change_count
 
-    # Check for track routing changes and if any ReaSamplOmatic5000's
-    # were added or removed.
-    if not no_routing_or_fx_change(current_track, current_track_routing):
-        parse_current()
-    elif False: # Disabled: too slow on Windows and not necessary.
-        # Check for note range changes.
-        for srange in samploranges:
-            is_different = False
+    if change_count != None:
+        if change_count == sync_change_count:
+            return False, None, None
+        sync_change_count = change_count
 
-            params = srange.fx.params
-            start = round(params["Note range start"] * 127)
-            if srange.start != start:
-                srange.start = start
-                is_different = True
+    project = rp.Project()
+    tracks = project.selected_tracks
+    n_tracks = len(tracks)
 
-            end = round(params["Note range end"] * 127)
-            if srange.end != end:
-                srange.end = end
-                is_different = True
+    # Check for track changes if not frozen.
+    if not frozen:
+        # Only show track info is precisely one is selected.
+        if n_tracks != 1:
+            return True, (None, ""), None
 
-            # Redraw if necessary.
-            if is_different:
-                srange.redraw()
+        # Check if the track has changed.
+        if track != tracks[0]:
+            return True, (tracks[0], str(tracks[0].name).strip()), None
+
+    # Check for ReaSamplOmatic5000 changes, using a snapshot of all tracks
+    # which have note ranges on them.
+    return True, None, take_snapshot(track_ids)
+
+
+
+# Check for changes in REAPER which take a bit more time.
+# Only called when not interacting with the UI. As above, nothing is done
+# if `change_count` did not change since the previous check. Runs on the
+# REAPER worker. Returns whether anything was checked, and whether the
+# track needs to be parsed again.
+slow_change_count = None
+def reaper_sync_slow(track, routing, change_count=None):
+    global slow_change_count
+
+    if not track or routing == None:
+        return False, False
+
+    if change_count != None:
+        if change_count == slow_change_count:
+            return False, False
+        slow_change_count = change_count
+
+    # Check for track routing changes and if any ReaSamplOmatic5000's
+    # were added or removed.
+    return True, not no_routing_or_fx_change(track.id, routing)
 
 
 
@@ -1613,58 +2948,110 @@ def resize(event, canvas, window_id):
     help_icon.place(x=root.winfo_width() - 28)
 
     # If necessary, resize (redraw) all notes.
-    max_height = int(window.winfo_height() - piano_roll_height)
-    if samploranges and samploranges[0].max_height != max_height:
-        for samplerange in samploranges:
-            samplerange.redraw()
+    global layout_height
+    max_height = range_height()
+    if layout_height != max_height:
+        layout_height = max_height
+        redraw_visible(True)
+
+
+# Only the sample ranges in view are laid out after zooming or resizing.
+# The others are hidden, and laid out once they scroll into view. Ranges
+# which are not laid out since the last change have an old `layout_version`.
+layout_version = 0
+layout_height = None
+
+# Returns the first and last note in view, with a note of margin.
+def visible_notes():
+    global canvas
+    first, last = canvas.xview()
+    return math.floor(first * 128) - 1, math.ceil(last * 128) + 1
+
+# Lay out the ranges in view which are not up to date. With `relayout`,
+# all ranges are out of date, and are hidden until they are laid out.
+def redraw_visible(relayout=False):
+    global layout_version, render_groups, window
+    if relayout:
+        layout_version += 1
+        window.itemconfig("srange", state="hidden")
+
+    first, last = visible_notes()
+    first, last = find_groups(render_groups, first, last)
+    for group in render_groups[first:last]:
+        for srange in group.sranges:
+            if srange.layout_version != layout_version:
+                srange.redraw()
 
+    # Draw right away, so the hidden ranges are never shown.
+    flush_redraw()
 
-# Zoom the note sizes. Update the piano notes and SamploRanges.
-# Also try to keep the zoom centered.
-# (this does not look very smooth, maybe it can be improved)
-def zoom(zoom):
-    global width_per_note, canvas, root
+# Called when the view is scrolled or resized.
+def view_changed(first, last):
+    global scrollbar
+    scrollbar.set(first, last)
+    redraw_visible()
 
-    canvas.forget()
+
+# Zoom the note sizes, keeping the same position under the cursor. All
+# items on the canvas are scaled at once. The sample ranges and the piano
+# notes are only laid out again (names included) once the zooming stopped
+# for a moment, see `zoom_done`.
+zoom_settle = None
+def zoom(zoom):
+    global width_per_note, canvas, window, root, zoom_settle
 
     # Set the new size
     width_per_note_old = width_per_note
     width_per_note += zoom
     width_per_note = max(5, width_per_note)
-
-    # Update the sizes
-    global pianoroll_frame, samploranges
-    for samplorange in samploranges:
-        samplorange.redraw()
-    for note_widget in pianoroll_frame.winfo_children():
-        note_widget.configure(width=width_per_note -
-                              adjust_for_highlight * highlight)
-
-    # Move the canvas view
-    global scrollbar
-    scroll_pos = canvas.xview()[0] * 128 * width_per_note_old
-    x_pos_before = root.winfo_pointerx() - root.winfo_rootx() + scroll_pos
-    x_pos_before = (x_pos_before // width_per_note_old) * width_per_note_old
-    x_pos_after = x_pos_before + (x_pos_before / width_per_note_old) * zoom
-
-    canvas.configure(xscrollincrement=1)
-    canvas.xview_scroll(round(x_pos_after - x_pos_before), "units")
-    canvas.configure(xscrollincrement=0)
-
-    canvas.pack(side="top", fill="both", expand=True)
+    if width_per_note == width_per_note_old:
+        return
+    scale = width_per_note / width_per_note_old
+
+    # The position of the cursor in the view, and on the canvas.
+    cursor = root.winfo_pointerx() - canvas.winfo_rootx()
+    cursor = min(max(cursor, 0), canvas.winfo_width())
+    x_pos = canvas.canvasx(cursor)
+
+    # Scale everything.
+    window.scale("all", 0, 0, scale, 1)
+    width = 128 * width_per_note
+    window.configure(width=width)
+
+    # Move the canvas view. The scroll region is set right away, since it
+    # otherwise is only updated after the canvas is resized.
+    canvas.configure(scrollregion=(0, 0, width, canvas.winfo_height()))
+    canvas.xview_moveto((x_pos * scale - cursor) / width)
+
+    if zoom_settle:
+        root.after_cancel(zoom_settle)
+    zoom_settle = root.after(zoom_settle_delay, zoom_done)
+
+# Lay out everything after zooming. Called early when the canvas is
+# clicked, since positions are only exact after this.
+def zoom_done():
+    global root, zoom_settle
+    if zoom_settle:
+        root.after_cancel(zoom_settle)
+        zoom_settle = None
+
+    layout_pianoroll()
+    redraw_visible(True)
 
 # Zoom the pianoroll view.
 def zoom_pianoroll(zoom):
-    global piano_roll_height, pianoroll_frame, samploranges
+    global piano_roll_height, pianoroll_y, window, samploranges
 
+    piano_roll_height_old = piano_roll_height
     piano_roll_height += 2 * zoom
     piano_roll_height = max(5, piano_roll_height)
 
-    for samplorange in samploranges:
-        samplorange.redraw()
-    for note_widget in pianoroll_frame.winfo_children():
-        note_widget.configure(height=piano_roll_height -
-                              adjust_for_highlight * highlight)
+    redraw_visible(True)
+
+    # Scale the keys from the bottom.
+    bottom = pianoroll_y + piano_roll_height_old
+    window.scale("pianoroll", 0, bottom, 1, piano_roll_height / piano_roll_height_old)
+    pianoroll_y = bottom - piano_roll_height
 
 
 # # # Copy, paste and delete # # #
@@ -1672,84 +3059,145 @@ def zoom_pianoroll(zoom):
 clipboard = []
 def copy():
     global samploranges, clipboard
-    clipboard = [srange for srange in samploranges if srange.selected]
+    clipboard = [srange for srange in samploranges if srange in selection]
 
-@rp.inside_reaper()
+# Copy the FX to the end of their track. Runs on the REAPER worker.
+# Returns the copies.
 @rp.undo_block('Multi-Sampler: paste sample ranges')
+def paste_in_reaper(fxs):
+    copies = []
+    for fx in fxs:
+        fx = resolve_fx(fx)
+        if not fx:
+            copies.append(None)
+            continue
+
+        track = fx.parent
+        fx_index = len(fx_cache.guids(track.id))
+        fx.copy_to_track(track, index=fx_index)
+        copies.append(new_fx_handle(track.id, fx_index))
+    return copies
+
 def paste():
-    global clipboard, window, render_groups
+    global clipboard
     deselect_all()
 
+    sources = []
     for srange in clipboard:
-            if not srange in samploranges:
-                print("FX {srange.fx.name} has been removed, skipping...")
-                continue
+        if not srange in samploranges or not srange.fx:
+            print(f"FX {srange.fx_name} has been removed, skipping...")
+            continue
+        sources.append(srange)
+
+    reaper_call(paste_in_reaper, [srange.fx for srange in sources],
+                callback=lambda fxs: paste_done(sources, fxs))
+
+def paste_done(sources, fxs):
+    global samploranges, window, render_groups
+    if isinstance(fxs, ReaperError):
+        return
+    soloing = any(s.solo for s in samploranges)
 
-            # Paste in REAPER
-            track = srange.fx.parent
-            fx_index = len(track.fxs)
-            srange.fx.copy_to_track(track, index=fx_index)
+    for srange, fx in zip(sources, fxs):
+            if not fx:
+                continue
 
-            # Add the sample range
-            srange_copy = SamploRange(window, track.fxs[fx_index], track.color)
+            # Add the sample range. The copy has the same state in REAPER.
+            srange_copy = SamploRange(window, fx, srange.color, srange.start,
+                                      srange.end, mute=not srange.reaper_enabled(soloing),
+                                      fx_name=srange.fx_name)
             srange_copy.track_routing = srange.track_routing
             srange_copy.track_routing.samplorange_count += 1
             samploranges.append(srange_copy)
 
             # Add to the render groups.
             move_through_groups(render_groups, srange_copy)
-            srange_copy.select(len(clipboard) > 1)
-
-            srange_copy.update_reaper()
-            srange.update_reaper()
+            srange_copy.select(len(sources) > 1)
 
 def delete_in_render_groups(srange):
     global render_groups
+    remove_from_groups(render_groups, srange)
 
-    srange.end = -100
-    srange.start = -100
-    move_through_groups(render_groups, srange)
-    render_groups.remove(srange.render_group)
-
-@rp.inside_reaper()
+# Delete the given (fx, name) tuples. They are deleted from the last to the
+# first, so the indices stay correct. Runs on the REAPER worker.
 @rp.undo_block('Multi-Sampler: delete sample ranges')
+def delete_in_reaper(fxs):
+    fxs = [(resolve_fx(fx), name) for fx, name in fxs]
+    fxs = [x for x in fxs if x[0]]
+    fxs.sort(key=lambda x: -x[0].index)
+
+    for fx, name in fxs:
+        try:
+            fx.delete()
+            fx_cache.remove(fx.parent_id, fx.guid)
+        except:
+            print(f"Could not delete FX {name}")
+
 def delete():
     global samploranges, render_groups
-    for srange in list(samploranges):
-        if srange.selected:
-            try:
-                track = srange.fx.parent
-                fx_index = srange.fx.index
-
-                # Delete in REAPER.
-                srange.fx.delete()
-
-                # Update the routing info
-                srange.track_routing.samplorange_count -= 1
-
-                # Make sure the other sample ranges have the
-                # correct FX indices.
-                for s in samploranges:
-                    if s.fx.parent == track:
-                        if s.fx.index > fx_index:
-                            s.fx = track.fxs[s.fx.index-1]
-
-                # Delete in the groups.
-                delete_in_render_groups(srange)
-
-                # Delete in tkinter and the samploranges list
-                srange.widget.destroy()
-                if srange.tooltip:
-                    srange.tooltip.destroy()
-                samploranges.remove(srange)
-            except:
-                print(f"Could not delete FX {srange.fx.name}")
+    selected = [s for s in selection if s.fx]
+    if not selected:
+        return
+
+    fxs = [(s.fx, s.fx_name) for s in selected]
 
+    for srange in selected:
+        # Update the routing info
+        if srange.track_routing:
+            srange.track_routing.samplorange_count -= 1
+
+        # Delete in the groups.
+        delete_in_render_groups(srange)
+
+        # Delete in tkinter and the samploranges list
+        srange.destroy()
+        samploranges.remove(srange)
+
+    # Delete in REAPER.
+    reaper_call(delete_in_reaper, fxs)
+
+
+# # # Selection # # #
+
+# The selected sample ranges, in the order in which they were selected.
+# Listeners are called with every range which gets selected or deselected,
+# so nothing needs to go through all sample ranges to find the selection.
+class Selection():
+    def __init__(self):
+        self.sranges = {}
+        self.listeners = []
+
+    def __contains__(self, srange):
+        return srange in self.sranges
+
+    def __len__(self):
+        return len(self.sranges)
+
+    # Iterates over a copy, so the selection can be changed meanwhile.
+    def __iter__(self):
+        return iter(list(self.sranges))
+
+    def add(self, srange):
+        if not srange in self.sranges:
+            self.sranges[srange] = None
+            self.notify(srange)
+
+    def discard(self, srange):
+        if srange in self.sranges:
+            del self.sranges[srange]
+            self.notify(srange)
+
+    def notify(self, srange):
+        for listener in self.listeners:
+            listener(srange)
+
+# Redraw the ranges of which the selection changed.
+selection = Selection()
+selection.listeners.append(lambda srange: mark_dirty(srange, place=False))
 
 # Deselects all samploranges.
 def deselect_all(exclude=None):
-    global samploranges
-    for srange in samploranges:
+    for srange in selection:
         if srange != exclude:
             srange.deselect()
 
@@ -1772,6 +3220,8 @@ def rectangle_select_start(event, keep_select=False):
     rectangle_base = [event.x, event.y]
 
     keep_selection = keep_select
+    if zoom_settle:
+        zoom_done()
 
     # When the event is started not on the main canvas,
     # we need to adjust the location.
@@ -1782,9 +3232,8 @@ def rectangle_select_start(event, keep_select=False):
         scroll_pos = canvas.xview()[0] * 128 * width_per_note
         rectangle_add[0] = round(scroll_pos)
         rectangle_add[1] = -track_name_label.winfo_height()
-    elif event.widget.winfo_height() == piano_roll_height and event.widget.winfo_y() == 0:
-        # Pianoroll buttons
-        rectangle_add[0] = event.widget.winfo_x()
+    elif event.widget is window and event.y >= pianoroll_y:
+        # Pianoroll keys
         rectangle_only_hor = True
     elif not event.widget is window:
         rectangle_add[0] = event.widget.winfo_x()
@@ -1796,15 +3245,21 @@ def rectangle_select_start(event, keep_select=False):
 def rectangle_intersect(a, b):
     return not (a[2] < b[0] or b[2] < a[0] or a[3] < b[1] or b[3] < a[1])
 
+# Select the ranges in the rectangle. Only the groups under the rectangle
+# are checked, with their geometry computed from the range store, and only
+# ranges which enter or leave the rectangle are redrawn.
+rectangle_selected = set()
 def rectangle_select(event):
     global rectangle_base, rectangle_add, rectangle_only_hor, selection_box, \
-           keep_selection, already_selected, samploranges, canvas
+           keep_selection, already_selected, rectangle_selected, samploranges, \
+           canvas, render_groups
 
     if not selection_box:
         root.config(cursor="plus" if keep_selection else "arrow")
         if not keep_selection:
             deselect_all()
-        already_selected = [s for s in samploranges if s.selected]
+        already_selected = set(selection)
+        rectangle_selected = set()
 
     a = rectangle_add
     x = [rectangle_base[0] + a[0], event.x + a[0]]
@@ -1814,33 +3269,34 @@ def rectangle_select(event):
     else:
         selection_box = [min(x), 0, max(x), canvas.winfo_height() * 2]
 
-    for srange in samploranges:
-        if srange in already_selected:
-            continue
-
-        x, y = srange.widget.winfo_x(), srange.widget.winfo_y()
-        w, h = srange.widget.winfo_width(), srange.widget.winfo_height()
-        box = [x, y, x + w, y + h]
-
-        # Check if in rectangle box.
-        if rectangle_intersect(selection_box, box):
-            srange.select(True, False)
-        else:
-            srange.deselect()
+    # Find the ranges in the rectangle.
+    max_height = range_height()
+    first = math.floor(selection_box[0] / width_per_note) - 1
+    last = math.floor(selection_box[2] / width_per_note) + 1
+    first, last = find_groups(render_groups, first, last)
+
+    candidates = [s for group in render_groups[first:last] for s in group.sranges
+                  if s not in already_selected]
+    inside = range_store.intersect([s.row for s in candidates],
+                                   selection_box, max_height)
+    inside = set(candidates[i] for i in inside)
+
+    # Only update the ranges which entered or left the rectangle.
+    for srange in inside - rectangle_selected:
+        srange.select(True, False)
+    for srange in rectangle_selected - inside:
+        srange.deselect()
+    rectangle_selected = inside
 
 def select_all():
     for srange in samploranges:
-        srange.selected = False
-        srange.select(True)
+        srange.select(True, False)
 
 def close_ui_selected():
-    selected = [s for s in samploranges if s.selected]
-    if len(selected) > 0:
-        for srange in selected:
-            srange.fx.close_ui()
-    else:
-        for srange in samploranges:
-            srange.fx.close_ui()
+    selected = list(selection)
+    if len(selected) == 0:
+        selected = samploranges
+    reaper_call(close_ui_in_reaper, [s.fx for s in selected if s.fx])
 
 # # # Copy / paste parameters # # #
 
@@ -1869,58 +3325,77 @@ params_note = [
      "Probability of hitting", "Round-robin mode"]
 
 def copy_params(params):
-    global params_copy, fx_copy_source, copy_fx_samples
-    selected = [s for s in samploranges if s.selected]
+    global fx_copy_source
+    selected = list(selection)
 
-    if len(selected) != 1:
-        rp.reaper.show_message_box("You need to select a single sample range to copy parameters.",
+    if len(selected) != 1 or not selected[0].fx:
+        reaper_call(rp.reaper.show_message_box,
+                "You need to select a single sample range to copy parameters.",
                 "Multi Sampler error: copying parameters", )
         return
 
     fx_copy_source = selected[0].fx
+    reaper_call(copy_params_in_reaper, fx_copy_source, params,
+                callback=copy_params_done)
+
+# Ask which parameters to copy, and read them. Runs on the REAPER worker.
+def copy_params_in_reaper(fx, params):
+    fx = resolve_fx(fx)
+    if not fx:
+        return None
 
     try:
         params_input = rp.reaper.get_user_inputs(
             "Fill in anything to copy, leave empty to skip", params)
-
-        if "Sample" in params_input:
-            copy_fx_samples = True
-            del params_input["Sample"]
-        else:
-            copy_fx_samples = False
-
-        params = (p[0] for p in params_input.items() if p[1] != "")
-        params_copy = {p: fx_copy_source.params[p] for p in params}
     except RuntimeError:
         print("Input aborted")
+        return None
 
-@rp.inside_reaper()
-@rp.undo_block('Multi-Sampler: paste parameters')
-def paste_params():
-    global params_copy, fx_copy_source, copy_fx_samples, samploranges
+    if "Sample" in params_input:
+        copy_samples = True
+        del params_input["Sample"]
+    else:
+        copy_samples = False
 
-    if not params_copy and not copy_fx_samples:
-        return
+    params = (p[0] for p in params_input.items() if p[1] != "")
+    return {p: fx.params[p] for p in params}, copy_samples
 
-    selected = (s for s in samploranges if s.selected)
+def copy_params_done(result):
+    global params_copy, copy_fx_samples
+    if result and not isinstance(result, ReaperError):
+        params_copy, copy_fx_samples = result
 
-    for srange in selected:
-        for p, value in params_copy.items():
-            srange.fx.params[p] = value
+# Runs on the REAPER worker.
+@rp.undo_block('Multi-Sampler: paste parameters')
+def paste_params_in_reaper(fxs, params, copy_samples, fx_source):
+    fx_source = resolve_fx(fx_source) if copy_samples else None
+    if not fx_source:
+        copy_samples = False
+
+    for fx in resolve_fxs(fxs):
+        for p, value in params.items():
+            fx.params[p] = value
 
         # Copy the sample.
-        if copy_fx_samples:
-            track_source = fx_copy_source.parent
+        if copy_samples:
             i = 0
             while filename := rp.reascript_api.TrackFX_GetNamedConfigParm(
-                    track_source.id, fx_copy_source.index,
+                    fx_source.parent_id, fx_source.index,
                     f"FILE{i}", "", 2**25)[4]:
-                rp.reascript_api.TrackFX_SetNamedConfigParm(srange.fx.parent.id,
-                        srange.fx.index, f"FILE{i}", filename)
+                rp.reascript_api.TrackFX_SetNamedConfigParm(fx.parent_id,
+                        fx.index, f"FILE{i}", filename)
                 i += 1
 
+def paste_params():
+    global params_copy, fx_copy_source, copy_fx_samples, samploranges
+
+    if not params_copy and not copy_fx_samples:
+        return
 
-    reaper_sync_slow()
+    selected = [s.fx for s in selection if s.fx]
+    reaper_call(paste_params_in_reaper, selected, params_copy or {},
+                copy_fx_samples, fx_copy_source)
+    sync_now(fast=False, force=True, reschedule=False)
 
 # # # Popup menu # # #
 
@@ -1928,6 +3403,9 @@ def popup_menu(event):
     global root
     root.config(cursor="arrow")
 
+    # Finish the rectangle select first.
+    flush_motion()
+
     global right_click_menu
 
     if selection_box == None:
@@ -1945,45 +3423,45 @@ def popup_close(event=None):
 
 # # # Mute / solo # # #
 
-@rp.undo_block('Multi-Sampler: toggle mute')
-@rp.inside_reaper()
+# Send the enabled state of the given sample ranges to REAPER at once.
+def update_reaper_enabled(sranges, undo_name):
+    global samploranges
+    soloing = any(s.solo for s in samploranges)
+    reaper_call(set_enabled_in_reaper,
+                [(s.fx, s.reaper_enabled(soloing)) for s in sranges if s.fx],
+                undo_name)
+
 def mute_selection(reset=False):
     global samploranges
-    selection = [s for s in samploranges if s.selected]
+    selected = list(selection)
 
-    mute = not all([s.mute for s in selection])
+    mute = not all([s.mute for s in selected])
 
     if reset:
+        changed = samploranges
         for srange in samploranges:
-            srange.set_mute(False)
+            srange.set_mute(False, False)
     else:
-        for srange in samploranges:
-            if srange.selected:
-                srange.set_mute(mute)
+        changed = selected
+        for srange in selected:
+            srange.set_mute(mute, False)
+
+    update_reaper_enabled(changed, 'Multi-Sampler: toggle mute')
 
-@rp.undo_block('Multi-Sampler: toggle solo')
-@rp.inside_reaper()
 def solo_selection(reset=False):
     global samploranges
-    selection = [s for s in samploranges if s.selected]
+    selected = list(selection)
 
-    solo = not all(s.solo for s in selection)
+    solo = not all(s.solo for s in selected)
 
     if reset:
         for srange in samploranges:
-            srange.set_solo(False)
+            srange.set_solo(False, False)
     else:
-        for srange in samploranges:
-            if srange.selected:
-                srange.set_solo(solo)
-
-    sranges_not_solo = [s for s in samploranges if not s.solo]
-    mute_others = len(sranges_not_solo) != len(samploranges)
-    for srange in sranges_not_solo:
-        if mute_others or srange.mute:
-            srange.fx.disable()
-        else:
-            srange.fx.enable()
+        for srange in selected:
+            srange.set_solo(solo, False)
+
+    update_reaper_enabled(samploranges, 'Multi-Sampler: toggle solo')
 
 def reset_solo_mute():
     solo_selection(True)
@@ -1992,20 +3470,14 @@ def reset_solo_mute():
 
 # # # REAPER forwarding # # #
 def undo():
-    global root
-    with rp.inside_reaper():
-        project = rp.Project()
-        project.perform_action(40029) # Action ID for undo.
-    reaper_sync()
-    reaper_sync_slow()
+    reaper_call(perform_action, 40029) # Action ID for undo.
+    sync_now(force=True, reschedule=False)
+    sync_scheduler.burst()
 
 def redo():
-    global root
-    with rp.inside_reaper():
-        project = rp.Project()
-        project.perform_action(40030) # Action ID for redo.
-    reaper_sync()
-    reaper_sync_slow()
+    reaper_call(perform_action, 40030) # Action ID for redo.
+    sync_now(force=True, reschedule=False)
+    sync_scheduler.burst()
 
 
 # # # MIDI routing # # #
@@ -2015,9 +3487,9 @@ def play_note(note, on, event=None):
     # Color the pianoroll note accordingly.
     black = (note % 12) in [1,3,6,8,10]
     if on:
-        event.widget.configure(bg='gray' if black else 'lightgray')
+        window.itemconfig(pianoroll_keys[note], fill='gray' if black else 'lightgray')
     else:
-        event.widget.configure(bg='black' if black else 'white')
+        window.itemconfig(pianoroll_keys[note], fill='black' if black else 'white')
 
 
     # Turn of all MIDI notes.
@@ -2025,42 +3497,59 @@ def play_note(note, on, event=None):
 
     msg = None
     if on:
-        msg = [144, note, int(event.y / piano_roll_height * 128)]
+        velocity = (event.y - pianoroll_y) / piano_roll_height
+        msg = [144, note, min(127, max(0, int(velocity * 128)))]
     else:
         msg = [128, note, 0]
 
-    rp.reascript_api.StuffMIDIMessage(0, *msg)
+    reaper_call(rp.reascript_api.StuffMIDIMessage, 0, *msg)
 
     # Necessary on some systems to close the popup menu.
     popup_close()
 
 def note_all_off():
-    rp.reascript_api.StuffMIDIMessage(0, 176, 123, 0)
+    reaper_call(rp.reascript_api.StuffMIDIMessage, 0, 176, 123, 0)
 
 # # # GUI setup # # #
 
 def close():
-    global running, root
+    global running, root, reaper_worker
     running = False
+    if control_server:
+        stop_control_server()
+    flush_reaper_writes()
+    reaper_worker.stop()
     root.destroy()
 
+    # Let the worker finish writing to REAPER.
+    reaper_worker.join(5)
+
+def open_github():
+    import webbrowser
+    webbrowser.open("https://github.com/maximvdberg/reasamplomatic5000-multi")
+
 # The main GUI construction function.
 def guimain():
-    global root, window, canvas, scrollbar, pixel, select_rect
-    global track_name_text, track_name_label, check_loop
+    global root, window, canvas, scrollbar, select_rect, range_font
+    global track_name_text, track_name_label, check_loop, reaper_worker
 
-    # Create the top level (root) window.
-    if dnd_available:
-        root = tkinterdnd2.Tk(className='samplomatic5000 multi')
-    else:
-        root = tk.Tk(className='samplomatic5000 multi')
+    # Create the top level (root) window. Drag-and-drop is added later, see
+    # `load_dnd`.
+    root = tk.Tk(className='samplomatic5000 multi')
     root.geometry(default_window_size)
+    tooltips.bind(root)
+
+    # Start the thread which communicates with REAPER.
+    reaper_worker = ReaperWorker()
+    reaper_worker.start()
+    root.after(results_interval, poll_reaper_results)
     root.tk_setPalette(background=background_color,
                                    foreground=foreground_color,
                                    highlightBackground=highlight_color)
 
-    # Create the virtual pixel
-    pixel = tk.PhotoImage(width=1, height=1)
+    # The font of the sample range names.
+    range_font = tkfont.nametofont("TkDefaultFont")
+    root.bind("<<TkWorldChanged>>", fonts_changed, add=True)
 
     # Create the buttons.
     buttons = tk.Frame(root)
@@ -2070,28 +3559,26 @@ def guimain():
     btn_init = tk.Button(buttons, text="Add", width=6, height=1, command=init, 
                          highlightbackground=background_color)
     btn_init.grid(column=(grid_index := grid_index + 1), row=0, padx=4, pady=4)
-    if tooltip_available:
-        ToolTip(btn_init, delay=tooltip_delay, msg=
-                "Add a new ReaSamplOmatic5000 instance to the currently "
-                "selected tracks. If no tracks are selected, create a new "
-                "one.")
+    tooltips.add(btn_init,
+                 "Add a new ReaSamplOmatic5000 instance to the currently "
+                 "selected tracks. If no tracks are selected, create a new "
+                 "one.")
 
     btn_separate = tk.Button(buttons, text="Separate", width=6,
                              height=1, command=separate,
                              highlightbackground=background_color)
     btn_separate.grid(column=(grid_index := grid_index + 1), row=0,
                       padx=4, pady=4)
-    if tooltip_available:
-        ToolTip(btn_separate, delay=tooltip_delay, msg=
-                "For all selected sample ranges, move the "
-                "ReaSamplOmatic5000 instance to a\nnew track,"
-                "and add MIDI routing from the selected track."
-                "You can keep managing\nthe instances from the "
-                "current track.\n\n"
-                "This allows you to create groups with separate "
-                "FX processing.\n\n"
-                "Note ranges are given the same color as the track.\n\n"
-                "See `Separate overlap` and `Create bus` for options.")
+    tooltips.add(btn_separate,
+                 "For all selected sample ranges, move the "
+                 "ReaSamplOmatic5000 instance to a\nnew track,"
+                 "and add MIDI routing from the selected track."
+                 "You can keep managing\nthe instances from the "
+                 "current track.\n\n"
+                 "This allows you to create groups with separate "
+                 "FX processing.\n\n"
+                 "Note ranges are given the same color as the track.\n\n"
+                 "See `Separate overlap` and `Create bus` for options.")
 
     # Buttons to zoom in and out.
     btn_zoom_in  = tk.Button(buttons, text="+", width=1, height=1,
@@ -2104,11 +3591,8 @@ def guimain():
                      padx=4, pady=4)
     btn_zoom_out.grid(column=(grid_index := grid_index + 1), row=0,
                       padx=4, pady=4)
-    if tooltip_available:
-        ToolTip(btn_zoom_in, msg="Zoom in.\n\nAlternatively, hold ctrl and scroll.",
-                delay=tooltip_delay)
-        ToolTip(btn_zoom_out, msg="Zoom out.\n\nAlternatively, hold ctrl and scroll.",
-                delay=tooltip_delay)
+    tooltips.add(btn_zoom_in, "Zoom in.\n\nAlternatively, hold ctrl and scroll.")
+    tooltips.add(btn_zoom_out, "Zoom out.\n\nAlternatively, hold ctrl and scroll.")
 
     # Create the checkboxes.
     global create_pitched, create_bus_on_separate, freeze, allow_reaper_drag_and_drop, \
@@ -2189,8 +3673,7 @@ def guimain():
             check.grid(column=(grid_index := grid_index + 1), row=check_row, padx=4, pady=4)
 
             # Create the tooltip
-            if tooltip_available:
-                ToolTip(check, msg=tooltip, delay=tooltip_delay)
+            tooltips.add(check, tooltip)
 
     # Create the help tooltip.
     global help_icon
@@ -2201,43 +3684,41 @@ def guimain():
     help_icon.tkraise()
     help_icon.place(x=root.winfo_width() - 20)
 
-    help_icon.bind("<Button-1>", lambda e:
-        webbrowser.open("https://github.com/maximvdberg/reasamplomatic5000-multi"))
-
-    if tooltip_available:
-        ToolTip(help_icon, delay=0.0,
-                msg="Tooltips are available!\n"
-                    "Hover over anything for more info.\n"
-                    "\n"
-                    "Click here to open the GitHub page, to\n"
-                    " - find a list of keyboard shortcuts,\n"
-                    " - open an issue to report bugs and\n"
-                    "   make feature requests.\n"
-                    "\n"
-                    "Right click+drag for rectangle select.\n"
-                    "Hold ctrl to add to selection.\n"
-                    "\n"
-                    "Hold ctrl and scroll to zoom. You can \n"
-                    "also change the piano notes size if you \n"
-                    "hold alt and scroll.\n"
-                    "\n"
-                    "Right click to open the action menu.\n"
-                    " - Most actions apply to the selection,\n"
-                    "   not the item under the cursor!\n"
-                    " - Reset mute/solo removes all applied\n"
-                    "   mutes and solos (ignoring selection).\n"
-                    " - Refresh reloads the multi sampler.\n"
-                    "   Use when de-synced with REAPER.\n"
-                    "\n"
-                    " Copy/paste params lets you copy any\n"
-                    " parameters of a specific instance of\n"
-                    " ReaSamplOmatic5000 to a selection.\n"
-                    " A popup will open where you can select\n"
-                    " which parameters to copy. Two sets\n"
-                    " are available:\n"
-                    "  - sample, concerning sample params\n"
-                    "  - note, concerning note/midi params"
-                )
+    help_icon.bind("<Button-1>", lambda e: open_github())
+
+    tooltips.add(help_icon,
+                 "Tooltips are available!\n"
+                 "Hover over anything for more info.\n"
+                 "\n"
+                 "Click here to open the GitHub page, to\n"
+                 " - find a list of keyboard shortcuts,\n"
+                 " - open an issue to report bugs and\n"
+                 "   make feature requests.\n"
+                 "\n"
+                 "Right click+drag for rectangle select.\n"
+                 "Hold ctrl to add to selection.\n"
+                 "\n"
+                 "Hold ctrl and scroll to zoom. You can \n"
+                 "also change the piano notes size if you \n"
+                 "hold alt and scroll.\n"
+                 "\n"
+                 "Right click to open the action menu.\n"
+                 " - Most actions apply to the selection,\n"
+                 "   not the item under the cursor!\n"
+                 " - Reset mute/solo removes all applied\n"
+                 "   mutes and solos (ignoring selection).\n"
+                 " - Refresh reloads the multi sampler.\n"
+                 "   Use when de-synced with REAPER.\n"
+                 "\n"
+                 " Copy/paste params lets you copy any\n"
+                 " parameters of a specific instance of\n"
+                 " ReaSamplOmatic5000 to a selection.\n"
+                 " A popup will open where you can select\n"
+                 " which parameters to copy. Two sets\n"
+                 " are available:\n"
+                 "  - sample, concerning sample params\n"
+                 "  - note, concerning note/midi params",
+                 delay=0.0)
 
     # Create the track label
     track_name_text = tk.StringVar()
@@ -2250,10 +3731,10 @@ def guimain():
     canvas = tk.Canvas(container, highlightthickness=0)
 
     scrollbar = tk.Scrollbar(container, orient="horizontal", command=canvas.xview)
-    window = tk.Frame(canvas, takefocus=True)
+    window = tk.Canvas(canvas, takefocus=True, highlightthickness=0, bd=0)
 
     window_id = canvas.create_window((0, 0), window=window, anchor="nw")
-    canvas['xscrollcommand'] = scrollbar.set
+    canvas['xscrollcommand'] = view_changed
 
     # Create the pianoroll
     gui_pianoroll()
@@ -2277,7 +3758,15 @@ def guimain():
     for k in keys_detect_pitch:
         canvas.bind_all(f"<{k}>", lambda e: detect_pitch_selected())
 
-    window.bind("<Button-1>", lambda e: deselect_all())
+    # Sample range mouse events.
+    window.bind("<Button-1>", lambda e: range_press(e, lambda s: s.select()))
+    window.bind("<Control-1>", lambda e: range_press(e, lambda s: s.select(True)))
+    window.bind('<Alt-1>' if not on_macOS else '<Option-1>',
+                lambda e: range_press(e, lambda s: s.set_alt()))
+    window.bind("<Double-Button-1>", lambda e: range_press(e, lambda s: s.show(True)))
+    window.bind("<B1-Motion>", range_drag)
+    window.bind("<ButtonRelease-1>", range_release)
+    tooltips.add(window, range_tooltip)
 
     # Option toggles.
     for k in keys_freeze:
@@ -2364,6 +3853,7 @@ def guimain():
     m.add_command(label = "Detect pitch", command=detect_pitch_selected)
     m.add_separator()
     m.add_command(label = "Refresh", command=refresh)
+    m.add_command(label = "Quit", command=close)
     m.bind("<FocusOut>", popup_close)
 
     right_click_menu = m
@@ -2376,14 +3866,15 @@ def guimain():
     if on_macOS:
         canvas.bind_all("<Button-2>",  lambda e: rectangle_select_start(e))
         canvas.bind_all("<Control-2>", lambda e: rectangle_select_start(e, True))
-        canvas.bind_all("<B2-Motion>", rectangle_select)
+        canvas.bind_all("<B2-Motion>", lambda e: defer_motion(rectangle_select, e))
     else:
         canvas.bind_all("<Button-3>",  lambda e: rectangle_select_start(e))
         canvas.bind_all("<Control-3>", lambda e: rectangle_select_start(e, True))
-        canvas.bind_all("<B3-Motion>", rectangle_select)
+        canvas.bind_all("<B3-Motion>", lambda e: defer_motion(rectangle_select, e))
 
     # Resizing
     window.bind("<Configure>", lambda e, c=canvas: c.configure(scrollregion=c.bbox("all")))
+    window.bind("<Configure>", lambda e: place_pianoroll(e.height), add="+")
     root.bind("<Configure>", lambda e, c=canvas, fid=window_id: resize(e, c, fid))
 
     # Scrolling with middle mouse button (doesn't seem to work very well though)
@@ -2420,106 +3911,286 @@ def guimain():
         canvas.bind_all("<Alt-Button-4>", lambda e, d=1: zoom_pianoroll_linux(d), add=True)
         canvas.bind_all("<Alt-Button-5>", lambda e, d=-1: zoom_pianoroll_linux(d), add=True)
 
-    # Drag-and-drop
-    if dnd_available:
-        container.drop_target_register(tkinterdnd2.DND_FILES)
-        container.dnd_bind('<<DropEnter>>', drop_enter)
-        container.dnd_bind('<<DropPosition>>', drop_position)
-        container.dnd_bind('<<DropLeave>>', drop_leave)
-        container.dnd_bind('<<Drop>>', drop)
-        container.drag_source_register(1, tkinterdnd2.DND_FILES)
-
-
     # Packing
     container.pack(side="bottom", fill="both", expand=True)
     scrollbar.pack(side="bottom", fill="x")
     canvas.pack(side="top", fill="both", expand=True)
 
-    # Setup the REAPER check loop.
-    check_loop = root.after(100, reaper_sync)
-    check_loop = root.after(200, sync)
+    # Show the window with the keyboard, and do the rest once it is drawn.
+    root.after(10, lambda c=canvas: c.xview_moveto(36/128)) # Scroll the view to C2
+    root.protocol("WM_DELETE_WINDOW", hide_window)
+    root.update()
+    startup_phase("window")
+    root.after_idle(startup_deferred, container)
 
     # Start the GUI loop.
-    root.after(10, lambda c=canvas: c.xview_moveto(36/128)) # Scroll the view to C2
-    root.update_idletasks()
-    root.deiconify()
-    root.protocol("WM_DELETE_WINDOW", close)
     root.mainloop()
 
 
-# Create the pianoroll GUI.
+# Create the pianoroll GUI. The keys are drawn at the bottom of the canvas,
+# and are all tagged with "pianoroll". The note under the cursor simply
+# follows from the position (see `pianoroll_note`).
 def gui_pianoroll():
-    global pixel, window, pianoroll_frame
-
-    w = width_per_note - adjust_for_highlight * highlight
-    h = piano_roll_height - adjust_for_highlight * highlight
-
-    pianoroll_frame = tk.Frame(window)
-    pianoroll_frame.pack(anchor = "w", side=tk.BOTTOM)
+    global window, pianoroll_keys, pianoroll_labels, pianoroll_y
 
-    octaves = 10
+    pianoroll_keys = []
+    pianoroll_labels = {}
+    pianoroll_y = 0
     for note in range(128):
         black = (note % 12) in [1,3,6,8,10]
         color = 'black' if black else 'white'
         fg_color = 'white' if black else 'black'
-        select_color = 'gray' if black else 'lightgray'
-        note_button = tk.Label(pianoroll_frame,
-                image=pixel,
-                text=f"C{note//12-1}" if note % 12 == 0 else " ",
-                width=w, height=h,
-                padx=0, pady=0,
-                highlightthickness=highlight,
-                highlightbackground="#F0F0F0",
-                bd=0,
-                bg=color,
-                fg=fg_color,
-                compound="c")
-        note_button.grid(column=note, row=0)
-        note_button.bind("<Button-1>", lambda e, i=note: play_note(i, True, e))
-        note_button.bind("<ButtonRelease-1>", lambda e, i=note: play_note(i, False, e))
-
-        if tooltip_available:
-            tooltip = ToolTip(note_button, delay=tooltip_delay,
-                              msg=f"Press to send MIDI note {note} to reaper. "
-                              "\n\nVertical position determines velocity.")
+        pianoroll_keys.append(window.create_rectangle(
+                0, 0, 0, 0, width=highlight, outline="#F0F0F0" if highlight else '',
+                fill=color, tags="pianoroll"))
+        if note % 12 == 0:
+            pianoroll_labels[note] = window.create_text(
+                    0, 0, text=f"C{note//12-1}", fill=fg_color, tags="pianoroll")
+
+    layout_pianoroll()
+    window.configure(width=128 * width_per_note)
+
+# Place all keys according to the current sizes.
+def layout_pianoroll():
+    global window
+    inset = highlight / 2
+    for note, key in enumerate(pianoroll_keys):
+        x = note * width_per_note
+        window.coords(key, x + inset, pianoroll_y + inset,
+                      x + width_per_note - inset, pianoroll_y + piano_roll_height - inset)
+    for note, label in pianoroll_labels.items():
+        window.coords(label, (note + 0.5) * width_per_note,
+                      pianoroll_y + piano_roll_height / 2)
+
+# Keep the keys at the bottom of the canvas, when its height changes.
+def place_pianoroll(height):
+    global window, pianoroll_y
+    y = height - piano_roll_height
+    window.move("pianoroll", 0, y - pianoroll_y)
+    pianoroll_y = y
+
+# Returns the note of the pianoroll key at the given position on the canvas,
+# or None if the position is not on the pianoroll.
+def pianoroll_note(x, y):
+    if y < pianoroll_y:
+        return None
+    note = math.floor(x / width_per_note)
+    return note if 0 <= note < 128 else None
+
+# # # Startup # # #
+
+# Remember (and print, if `print_startup_timings` is set) how long each
+# phase of starting up took. Every phase is only timed once.
+startup_timings = {}
+startup_phase_time = startup_time
+def startup_phase(name):
+    global startup_phase_time
+    if name in startup_timings:
+        return
+
+    now = time.perf_counter()
+    startup_timings[name] = now - startup_phase_time
+    startup_phase_time = now
+    if print_startup_timings:
+        print(f"Startup: {name} took {startup_timings[name] * 1000:.0f} ms "
+              f"({(now - startup_time) * 1000:.0f} ms in total)")
+
+# Everything which is not needed to show the window. The first parse goes
+# first, so the sample ranges show up as soon as possible.
+def startup_deferred(container):
+    global sync_scheduler
+
+    # Setup the REAPER check loop. Poll quickly again after any
+    # interaction with the window.
+    sync_now(slow=False, force=True, reschedule=False)
+    sync_scheduler = SyncScheduler(sync, sync_interval_min,
+                                   sync_interval_max, sync_backoff)
+    sync_scheduler.schedule()
+    for event in ["<ButtonPress>", "<KeyPress>", "<FocusIn>", "<FocusOut>"]:
+        root.bind(event, lambda e: sync_scheduler.burst(), add="+")
+
+    reaper_call(register_detect_pitch, callback=register_detect_pitch_done)
+
+    load_dnd(container)
+    load_numpy()
+    startup_phase("optional packages")
+
+    # Launched again while starting up, see `request_raise`.
+    if raise_requested:
+        show_window()
+
+def load_dnd(container):
+    global dnd_available
+    try:
+        import tkinterdnd2
+        tkinterdnd2.TkinterDnD._require(root)
+        dnd_available = True
+        print("Drag-and-drop available")
+    except:
+        print("Install tkinterdnd2 for drag-and-drop support.")
+        return
+
+    container.drop_target_register(tkinterdnd2.DND_FILES)
+    container.dnd_bind('<<DropEnter>>', drop_enter)
+    container.dnd_bind('<<DropPosition>>', drop_position)
+    container.dnd_bind('<<DropLeave>>', drop_leave)
+    container.dnd_bind('<<Drop>>', drop)
+    container.drag_source_register(1, tkinterdnd2.DND_FILES)
+
+# The range store switches to numpy columns once it is loaded.
+def load_numpy():
+    global np, numpy_available
+    try:
+        import numpy as np
+        numpy_available = True
+        print("NumPy available")
+    except:
+        print("Install numpy for faster editing of many samples at once.")
+        return
+
+    range_store.use_numpy()
+
+# Add the pitch detection script as an action, if the JS ReaScript API is
+# available. Runs on the REAPER worker.
+def register_detect_pitch():
+    if not rp.reascript_api.APIExists('JS_Window_OnCommand'):
+        print("Install the JS ReaScript API to enable automatic pitch detection")
+        return 0
+
+    path_dir = os.path.join(rp.reaper.get_resource_path(), "Scripts/ReaSamplOmatic5000 Multi/Sampler/")
+    path = os.path.join(path_dir, "reasamplomatic_multi_detect_pitch.lua")
+    print("Automatic detect pitch enabled")
+    return rp.reaper.add_reascript(path)
+
+def register_detect_pitch_done(script_id):
+    global detect_pitch_script_id
+    if isinstance(script_id, ReaperError):
+        return
+    detect_pitch_script_id = script_id
+    startup_phase("pitch detection script")
+
+
+# # # Resident instance # # #
+
+# With `resident` set, the first instance listens on `control_port` of the
+# local host. Later launches ask it to show its window and exit, which is
+# much faster than starting again. Closing the window then only hides it.
+control_server = None
+raise_requested = False
+
+# Returns whether a running instance answered.
+def raise_running_instance():
+    try:
+        with socket.create_connection(("127.0.0.1", control_port), timeout=1) as connection:
+            connection.sendall(b"raise\n")
+            return connection.recv(16) == b"ok\n"
+    except OSError:
+        return False
+
+def start_control_server():
+    global control_server
+    try:
+        control_server = socket.create_server(("127.0.0.1", control_port))
+    except OSError:
+        print(f"Port {control_port} is in use, not staying resident.")
+        return
+
+    threading.Thread(target=control_loop, daemon=True).start()
+
+# Shutting down also wakes up `control_loop`, which is waiting for launches.
+def stop_control_server():
+    try:
+        control_server.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    control_server.close()
+
+# Runs on its own thread, until the server is stopped by `close`.
+def control_loop():
+    while True:
+        try:
+            connection, _ = control_server.accept()
+        except OSError:
+            return
+
+        with connection:
+            try:
+                connection.settimeout(1)
+                if connection.recv(16) == b"raise\n":
+                    request_raise()
+                    connection.sendall(b"ok\n")
+            except OSError:
+                pass
+
+# Runs on the control thread. Tk can not be reached while the window is
+# still being built, so then `startup_deferred` shows it instead.
+def request_raise():
+    global raise_requested
+    try:
+        root.after_idle(show_window)
+    except (AttributeError, RuntimeError, tk.TclError):
+        raise_requested = True
+
+def show_window():
+    if root.state() == "withdrawn":
+        root.deiconify()
+
+        # Catch up with the changes made in REAPER meanwhile.
+        sync_scheduler.burst()
+        sync_now(force=True, reschedule=False)
+
+    root.lift()
+    root.focus_force()
+
+# Called when the window is closed. When resident, only hide it.
+def hide_window():
+    if not control_server:
+        close()
+        return
+
+    flush_reaper_writes()
+    note_all_off()
+    popup_close()
+    tooltips.hide()
+    root.withdraw()
+
 
 # # # Main # # #
 
 if __name__ == "__main__":
     sep = "/"
+    startup_phase("imports")
 
     # Check system.
-    creationflags = 0
     if sys.platform.startswith('win32'):
         # TODO: check other platforms which also need this.
         adjust_for_highlight = 2
         sep = "\\"
-        creationflags = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
     elif sys.platform.startswith("darwin"):
         on_macOS = True
 
-    # Add the other actions
-    # check if JS ReaScript API is available
-    if rp.reascript_api.APIExists('JS_Window_OnCommand'):
-        js_exists = True;
-        path_dir = os.path.join(rp.reaper.get_resource_path(), "Scripts/ReaSamplOmatic5000 Multi/Sampler/")
-        path = os.path.join(path_dir, "reasamplomatic_multi_detect_pitch.lua")
-        detect_pitch_script_id = rp.reaper.add_reascript(path)
-        print("Automatic detect pitch enabled")
-    else:
-        print("Install the JS ReaScript API to enable automatic pitch detection")
-
-    if rp.is_inside_reaper():
+    if resident and raise_running_instance():
+        print("Showing the multi sampler which is already running.")
+    elif rp.is_inside_reaper():
         # raise Exception("Please run `launch-sampler.py` to launch the "
         #                 "multi-sampler from inside of REAPER.")
         # Open itself as a new process.
+        import subprocess
+        creationflags = 0
+        if sys.platform.startswith('win32'):
+            creationflags = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
         path = f"{sep}Scripts{sep}ReaSamplOmatic5000 Multi{sep}Sampler{sep}reasamplomatic_multi.py"
         multisampler_process = subprocess.Popen(["python",  rp.reaper.get_resource_path() + path],
                 start_new_session=True, creationflags=creationflags)
     else:
+        if resident:
+            start_control_server()
+
         rp.reconnect()
+        startup_phase("connecting to REAPER")
 
-        # Setup the GUI.
+        # Setup the GUI. The pitch detection script is added once the
+        # window is shown.
         guimain()
 
 